@@ -1,18 +1,31 @@
 import re
 import os
-import shutil
+import time
+import hashlib
+import asyncio
 from docker import errors as docker_errors
-import pandas as pd
 
 from enum import Enum
-from requests import post
+from uuid import uuid4
+from typing import Callable
+from urllib.parse import quote
+from requests import get, post, put, delete, RequestException
+import aiohttp
 
 from extensions.auto_llama.llm import LLMInterface
+from extensions.auto_llama.context import ContextBudget
+from extensions.auto_llama.schema import (
+    SchemaCache,
+    COLUMNAR_FILETYPES,
+    arrow_available,
+    csv_to_arrow,
+)
 from extensions.auto_llama.tool import (
     BaseTool,
     ActionStep,
     FinalStep,
-    NoneTool,
+    ToolRunner,
+    ToolRegistry,
 )
 from extensions.auto_llama.templates import (
     ToolChainTemplate,
@@ -27,12 +40,35 @@ def is_active(agent: str):
     return agent in shared.active_agents
 
 
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
 class AgentError(Exception):
     """Action chain failed"""
 
     pass
 
 
+class CodeExecutionError(AgentError):
+    """Executed code failed"""
+
+    def __init__(self, status: str, error: dict = None):
+        self.status = status
+        self.error = error or {}
+
+        message = f"{self.error.get('type', 'Error')}: {self.error.get('message', status)}"
+        if self.error.get("line") is not None:
+            message += f" (line {self.error['line']})"
+
+        super().__init__(message)
+
+
 class AnswerType(Enum):
     """Different types of results from the AutoLLaMa Agent"""
 
@@ -55,36 +91,71 @@ class AnswerType(Enum):
 class SummaryAgent:
     """AutoLLaMa Agent which summarizes text"""
 
+    def __init__(
+        self,
+        name: str,
+        prompt_template: SummaryTemplate,
+        llm: LLMInterface,
+        verbose: bool = False,
+    ):
+        self.name = name
+        self.prompt_template = prompt_template
+        self.llm = llm
+        self.verbose = verbose
+
+    def _generate_prompt(self, objective: str, text: str) -> str:
+        print(f"> Running Agent: {self.name}")
+
+        prompt = self.prompt_template.template.format(objective=objective, text=text)
+
+        if self.verbose:
+            print("Prompting LLM: ----------")
+            print(prompt)
+
+        return prompt
+
+    def _process_summary(self, summary: str) -> tuple[AnswerType, str]:
+        if self.verbose:
+            print("Response: ----------")
+            print(summary)
+
+        return (AnswerType.RESPONSE, summary)
 
-def __init__(
-    self,
-    name: str,
-    prompt_template: SummaryTemplate,
-    llm: LLMInterface,
-    verbose: bool = False,
-):
-    self.name = name
-    self.prompt_template = prompt_template
-    self.llm = llm
-    self.verbose = verbose
+    def run(self, objective: str, text: str) -> tuple[AnswerType, str]:
+        prompt = self._generate_prompt(objective, text)
+        summary = self.llm.completion(prompt, temperature=0.8, max_new_tokens=400)
 
+        return self._process_summary(summary)
+
+    async def arun(self, objective: str, text: str) -> tuple[AnswerType, str]:
+        prompt = self._generate_prompt(objective, text)
+        summary = await self.llm.acompletion(
+            prompt, temperature=0.8, max_new_tokens=400
+        )
 
-def run(self, objective: str, text: str) -> tuple[AnswerType, str]:
-    print(f"> Running Agent: {self.name}")
+        return self._process_summary(summary)
 
-    prompt = self.prompt_template.template.format(objective=objective, text=text)
+    def run_batch(
+        self, items: list[tuple[str, str]]
+    ) -> list[tuple[AnswerType, str]]:
+        """Summarize multiple (objective, text) pairs in one batched LLM request"""
 
-    if self.verbose:
-        print("Prompting LLM: ----------")
-        print(prompt)
+        prompts = [self._generate_prompt(objective, text) for objective, text in items]
+        summaries = self.llm.batch_completion(
+            prompts, temperature=0.8, max_new_tokens=400
+        )
 
-    summary = self.llm.completion(prompt, temperature=0.8, max_new_tokens=400)
+        return [self._process_summary(summary) for summary in summaries]
 
-    if self.verbose:
-        print("Response: ----------")
-        print(summary)
+    async def arun_batch(
+        self, items: list[tuple[str, str]]
+    ) -> list[tuple[AnswerType, str]]:
+        prompts = [self._generate_prompt(objective, text) for objective, text in items]
+        summaries = await self.llm.abatch_completion(
+            prompts, temperature=0.8, max_new_tokens=400
+        )
 
-    return (AnswerType.RESPONSE, summary)
+        return [self._process_summary(summary) for summary in summaries]
 
 
 class CodeAgent:
@@ -93,8 +164,14 @@ class CodeAgent:
     CONTAINER_PATH = os.path.abspath(
         os.path.join(os.path.dirname(__file__), "code_exec")
     )
-    allowed_filetypes = ["csv"]
+    CONVERTED_PATH = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "cache", "data"
+    )
+    allowed_filetypes = ["csv", "parquet", "feather", "arrow"]
+    columnar_filetypes = COLUMNAR_FILETYPES
     allowed_languages = ["python"]
+    FINISHED_STATES = ["done", "failed", "timeout", "cancelled"]
+    DEFAULT_CONVERSATION = "default"
 
     def __init__(
         self,
@@ -103,15 +180,49 @@ class CodeAgent:
         llm: LLMInterface,
         pkg: list[str],
         executor_port: int = 6000,
+        execution_timeout: float = 300,
+        poll_interval: float = 0.5,
+        request_timeout: float = 30,
+        stop_check: Callable[[], bool] = None,
+        schema_cache: SchemaCache = None,
+        convert_csv: bool = False,
         verbose: bool = False,
     ) -> None:
+        """
+        ARGUMENTS
+            execution_timeout (float): Seconds after which the executor kills the code
+            poll_interval (float): Seconds between two status requests for running code
+            request_timeout (float): Seconds to wait for a response of the executor
+            stop_check (Callable[[], bool]): Returns True if the running code should be cancelled
+            schema_cache (SchemaCache): Inferred schemas of the data files
+            convert_csv (bool): Convert added CSV files to Arrow files (in cache/data) once, so scripts can memory-map them. Requires pyarrow
+        """
+
         self.name = name
         self.prompt_template = prompt_template
         self.llm = llm
         self.pkg = pkg
         self.data: dict[str, str] = {}
+        self.data_paths: dict[str, str] = {}
+        """ Local files of the uploaded data """
         self.executor_endpoint = f"http://localhost:{executor_port}"
         self.verbose = verbose
+        self.execution_timeout = execution_timeout
+        self.poll_interval = poll_interval
+        self.schema_cache = schema_cache or SchemaCache()
+        self.convert_csv = convert_csv
+
+        if convert_csv and not arrow_available():
+            print("> pyarrow is not installed, CSV files are uploaded unchanged")
+            self.convert_csv = False
+        self.sessions: dict[str, str] = {}
+        """ Session in the executor of each conversation, its variables persist between runs """
+        self.variables: dict[str, dict[str, str]] = {}
+        """ Names (and their type) defined in each session """
+        self.request_timeout = request_timeout
+        self.stop_check = stop_check
+        self.jobs: set[str] = set()
+        """ Jobs of the code which runs at the moment """
 
         self._mount_container(executor_port)
 
@@ -163,12 +274,10 @@ class CodeAgent:
         print(f"> Code executor is running on {self.executor_endpoint}")
 
     def add_data(self, *paths: str):
-        """Add data (.csv or similar) to the code executor"""
+        """Upload data (.csv or similar) to the code executor"""
 
         print(f"> Adding Data to {self.name}")
 
-        data_path = os.path.join(self.CONTAINER_PATH, "static", "files")
-
         for path in paths:
             basename = os.path.basename(path)
             file_type = basename.split(".")[-1].lower()
@@ -176,13 +285,87 @@ class CodeAgent:
             if file_type not in self.allowed_filetypes:
                 raise ValueError(f"Unsupported file type {file_type}")
 
-            self.data[basename] = file_type
+            if file_type in self.columnar_filetypes and not arrow_available():
+                raise ValueError(f"pyarrow is required to read {file_type} files")
 
-            # TODO: Move file into data folder of the container
-            shutil.copy(path, data_path)
+            if file_type == "csv" and self.convert_csv:
+                if self.verbose:
+                    print(f"> Converting {basename} to Arrow")
+
+                # Keyed on the content, files with the same name don't share a conversion
+                converted_path = os.path.join(self.CONVERTED_PATH, file_sha256(path))
+                os.makedirs(converted_path, exist_ok=True)
+                path = csv_to_arrow(
+                    path,
+                    os.path.join(
+                        converted_path, f"{os.path.splitext(basename)[0]}.arrow"
+                    ),
+                )
+                file_type = "arrow"
+
+            name = self._upload(path)
+
+            self.data[name] = file_type
+            self.data_paths[name] = path
+
+            # Infer the schema once instead of on every run
+            self.schema_cache.get(path, file_type)
 
         print(f">> Data: {', '.join([x for x in self.data.keys()])}")
 
+    def _upload(self, path: str) -> str:
+        """Stream a file to the executor unless it holds the same content already
+
+        RETURNS
+            name (str): Name of the file in the executor
+        """
+
+        sha256 = file_sha256(path)
+        url = f"{self.executor_endpoint}/data/{quote(os.path.basename(path), safe='')}"
+
+        res = get(f"{url}/info", timeout=self.request_timeout)
+        if res.status_code == 200 and res.json()["sha256"] == sha256:
+            if self.verbose:
+                print(f"> {os.path.basename(path)} is unchanged")
+
+            return res.json()["name"]
+
+        with open(path, "rb") as f:
+            res = put(
+                url,
+                data=f,
+                headers={"X-Content-SHA256": sha256},
+                timeout=self.request_timeout,
+            )
+
+        if res.status_code not in (200, 201):
+            raise AgentError(f"Failed to upload {path}")
+
+        return res.json()["name"]
+
+    def _session(self, conversation: str) -> str:
+        """ID of the executor session of a conversation"""
+
+        if conversation not in self.sessions:
+            self.sessions[conversation] = uuid4().hex
+
+        return self.sessions[conversation]
+
+    def reset_session(self, conversation: str = None):
+        """Drop all variables of previous runs in a conversation (or in all of them)"""
+
+        conversations = list(self.sessions) if conversation is None else [conversation]
+
+        for conversation in conversations:
+            session = self.sessions.pop(conversation, None)
+
+            if session is not None:
+                self.variables.pop(session, None)
+                delete(
+                    f"{self.executor_endpoint}/session/{session}",
+                    timeout=self.request_timeout,
+                )
+
     def add_pkg(self, *packages: str):
         """Extend list of usable python packages"""
 
@@ -193,56 +376,185 @@ class CodeAgent:
     def _generate_file_prompt(self, file: tuple[str, str]):
         """Generate prompt for file with example"""
 
-        prompt = f"{file[0]}:"
+        schema = self.schema_cache.get(self.data_paths[file[0]], file[1])
+
+        return schema.to_prompt(file[0])
 
-        if file[1] == "csv":
-            df = pd.read_csv(
-                os.path.join(self.CONTAINER_PATH, "static", "files", file[0])
+    def _generate_files_prompt(self) -> str:
+        prompt = "\n".join(
+            [self._generate_file_prompt(file) for file in self.data.items()]
+        )
+
+        if any(t in self.columnar_filetypes for t in self.data.values()):
+            prompt += (
+                "\nLoad files with load_data(name, columns=None), which returns a "
+                "pandas DataFrame (Arrow files are memory-mapped)"
             )
 
-            # Load header and data types of each column in the csv
-            cols = [f"{col}: {df[col].dtype}" for col in df.columns]
+        return prompt
+
+    def _generate_session_prompt(self, conversation: str) -> str:
+        variables = self.variables.get(self.sessions.get(conversation), {})
 
-            prompt += " | ".join(cols)
-            return prompt
+        if not variables:
+            return ""
+
+        return (
+            "\nThe code runs in the same Python session as the previous code, so its "
+            "variables still exist and can be reused instead of loading the data again: "
+            + ", ".join(f"{name} ({type})" for name, type in variables.items())
+        )
 
     def _extract_code(self, text: str):
         """Extract code from llm response"""
 
-        pattern = r"```(?P<language>.*)\n(?P<code>[^`]*)\n```"
+        return self.prompt_template.parser.extract(text)
+
+    def _job_request(self, code: str, conversation: str, epoch: int = None) -> dict:
+        return {
+            "code": code,
+            "session": self._session(conversation),
+            "timeout": self.execution_timeout,
+            "epoch": epoch,
+        }
 
-        match = re.search(pattern, text)
+    def _job_result(self, job: dict, conversation: str) -> tuple[str, list[str]]:
+        # Failed code keeps the variables it defined before the error
+        if job["result"] and job["result"].get("variables") is not None:
+            self.variables[self._session(conversation)] = job["result"]["variables"]
+
+        if job["status"] != "done":
+            raise CodeExecutionError(
+                job["status"], job["result"] and job["result"]["error"]
+            )
 
-        if match is None:
-            raise ValueError("No code found in response")
+        return (job["result"]["response"], job["result"]["images"])
 
-        language = match.group("language")
-        code = match.group("code").strip()
+    def _print_output(self, output: str):
+        if self.verbose and output:
+            print(output, end="", flush=True)
 
-        return (language, code)
+    def _stopped(self) -> bool:
+        return self.stop_check is not None and self.stop_check()
 
-    def _execute_code(self, code: str):
+    def _execute_code(self, code: str, conversation: str, epoch: int = None):
         """Execute code in sandboxed environment and return output"""
 
-        res = post(self.executor_endpoint, json={"code": code})
+        res = post(
+            f"{self.executor_endpoint}/job",
+            json=self._job_request(code, conversation, epoch),
+            timeout=self.request_timeout,
+        )
 
         if res.status_code != 200:
             raise AgentError("Failed to execute code")
 
-        res_dict = res.json()
+        job_id = res.json()["id"]
+        job_endpoint = f"{self.executor_endpoint}/job/{job_id}"
+        self.jobs.add(job_id)
+
+        try:
+            # Follow the output until the job is finished
+            offset = 0
+            cancelled = False
+            while True:
+                if not cancelled and self._stopped():
+                    self._cancel_job(job_id)
+                    cancelled = True
+
+                res = get(
+                    f"{job_endpoint}/output",
+                    params={"offset": offset},
+                    timeout=self.request_timeout,
+                )
+
+                if res.status_code != 200:
+                    raise AgentError("Failed to execute code")
+
+                out = res.json()
+                offset = out["offset"]
+                self._print_output(out["output"])
+
+                if not out["output"]:
+                    if out["status"] in self.FINISHED_STATES:
+                        break
+
+                    time.sleep(self.poll_interval)
+
+            job = get(job_endpoint, timeout=self.request_timeout).json()
+        finally:
+            self.jobs.discard(job_id)
+
+        return self._job_result(job, conversation)
+
+    async def _aexecute_code(self, code: str, conversation: str, epoch: int = None):
+        """Execute code in sandboxed environment without blocking the event loop"""
+
+        async with aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self.request_timeout)
+        ) as session:
+            async with session.post(
+                f"{self.executor_endpoint}/job",
+                json=self._job_request(code, conversation, epoch),
+            ) as res:
+                if res.status != 200:
+                    raise AgentError("Failed to execute code")
+
+                job_id = (await res.json())["id"]
+
+            job_endpoint = f"{self.executor_endpoint}/job/{job_id}"
+            self.jobs.add(job_id)
+
+            try:
+                offset = 0
+                cancelled = False
+                while True:
+                    if not cancelled and self._stopped():
+                        async with session.delete(job_endpoint):
+                            cancelled = True
+
+                    async with session.get(
+                        f"{job_endpoint}/output", params={"offset": offset}
+                    ) as res:
+                        if res.status != 200:
+                            raise AgentError("Failed to execute code")
+
+                        out = await res.json()
+
+                    offset = out["offset"]
+                    self._print_output(out["output"])
+
+                    if not out["output"]:
+                        if out["status"] in self.FINISHED_STATES:
+                            break
+
+                        await asyncio.sleep(self.poll_interval)
+
+                async with session.get(job_endpoint) as res:
+                    job = await res.json()
+            finally:
+                self.jobs.discard(job_id)
+
+        return self._job_result(job, conversation)
+
+    def _cancel_job(self, job_id: str):
+        delete(f"{self.executor_endpoint}/job/{job_id}", timeout=self.request_timeout)
+
+    def cancel(self):
+        """Kill the code which runs at the moment"""
 
-        return (res_dict["response"], res_dict["images"])
+        for job_id in list(self.jobs):
+            self._cancel_job(job_id)
 
-    def run(self, objective: str) -> list[tuple[AnswerType, str]]:
+    def _generate_prompt(self, objective: str, conversation: str) -> str:
         print(f"> Running Agent: {self.name}")
 
         print(self.data)
 
         prompt = self.prompt_template.template.format(
             objective=objective,
-            files="\n".join(
-                [self._generate_file_prompt(file) for file in self.data.items()]
-            ),
+            files=self._generate_files_prompt()
+            + self._generate_session_prompt(conversation),
             packages=", ".join(self.pkg),
         )
 
@@ -250,7 +562,17 @@ class CodeAgent:
             print("Prompting LLM: ----------")
             print(prompt)
 
-        result = self.llm.completion(prompt, max_new_tokens=800)
+        return prompt
+
+    def _parse_output(
+        self, prompt: str, result: str
+    ) -> tuple[str | None, list[tuple[AnswerType, str]]]:
+        """Extract executable code from the LLM response
+
+        RETURNS
+            code (str | None): Code which should be executed or None if no valid code was found
+            answers (list[tuple[AnswerType, str]]): Answers if no code can be executed
+        """
 
         if self.verbose:
             print("Response: ----------")
@@ -259,22 +581,22 @@ class CodeAgent:
         try:
             lang, code = self._extract_code(prompt + result)
         except ValueError:
-            return [(AnswerType.CHAT, "No valid code found in response")]
+            return (None, [(AnswerType.CHAT, "No valid code found in response")])
 
         if lang not in self.allowed_languages:
-            return [
-                (AnswerType.CHAT, code),
-                (AnswerType.CHAT, f"Unsupported language {lang}"),
-            ]
+            return (
+                None,
+                [
+                    (AnswerType.CHAT, code),
+                    (AnswerType.CHAT, f"Unsupported language {lang}"),
+                ],
+            )
 
-        try:
-            output, images = self._execute_code(code)
-        except AgentError:
-            return [
-                (AnswerType.CHAT, code),
-                (AnswerType.CHAT, "Failed to execute code"),
-            ]
+        return (code, [])
 
+    def _format_answers(
+        self, code: str, output: str, images: list[str]
+    ) -> list[tuple[AnswerType, str]]:
         return [
             (AnswerType.CHAT, code),
             (AnswerType.CHAT, output),
@@ -284,6 +606,58 @@ class CodeAgent:
             ],
         ]
 
+    def run(
+        self,
+        objective: str,
+        conversation: str = DEFAULT_CONVERSATION,
+        epoch: int = None,
+    ) -> list[tuple[AnswerType, str]]:
+        """
+        ARGUMENTS
+            conversation (str): Chat whose executor session is used
+            epoch (int): State of the session (e.g. the turn of the chat). If given, the executor may return the cached result of the same code from the same state
+        """
+
+        prompt = self._generate_prompt(objective, conversation)
+        result = self.llm.completion(prompt, max_new_tokens=800)
+
+        code, answers = self._parse_output(prompt, result)
+        if code is None:
+            return answers
+
+        try:
+            output, images = self._execute_code(code, conversation, epoch)
+        except (AgentError, RequestException) as err:
+            return [
+                (AnswerType.CHAT, code),
+                (AnswerType.CHAT, f"Failed to execute code: {err}"),
+            ]
+
+        return self._format_answers(code, output, images)
+
+    async def arun(
+        self,
+        objective: str,
+        conversation: str = DEFAULT_CONVERSATION,
+        epoch: int = None,
+    ) -> list[tuple[AnswerType, str]]:
+        prompt = self._generate_prompt(objective, conversation)
+        result = await self.llm.acompletion(prompt, max_new_tokens=800)
+
+        code, answers = self._parse_output(prompt, result)
+        if code is None:
+            return answers
+
+        try:
+            output, images = await self._aexecute_code(code, conversation, epoch)
+        except (AgentError, aiohttp.ClientError, asyncio.TimeoutError) as err:
+            return [
+                (AnswerType.CHAT, code),
+                (AnswerType.CHAT, f"Failed to execute code: {err}"),
+            ]
+
+        return self._format_answers(code, output, images)
+
     def __del__(self):
         try:
             container = shared.docker_client.containers.get(self.container_name)
@@ -309,7 +683,7 @@ class ObjectiveAgent:
         self.tools = tools
         self.verbose = verbose
 
-    def run(self, text: str) -> tuple[AnswerType, str]:
+    def _generate_prompt(self, text: str) -> str:
         print(f"> Running Agent: {self.name}")
 
         prompt = self.prompt_template.template.format(
@@ -323,14 +697,117 @@ class ObjectiveAgent:
             print("Prompting LLM: ----------")
             print(prompt)
 
-        objective = self.llm.completion(prompt, max_new_tokens=100)
+        return prompt
 
+    def _process_objective(self, objective: str) -> tuple[AnswerType, str]:
         if self.verbose:
             print("Response: ----------")
             print(objective)
 
         return (AnswerType.CHAT, objective)
 
+    def run(self, text: str) -> tuple[AnswerType, str]:
+        prompt = self._generate_prompt(text)
+        objective = self.llm.completion(prompt, max_new_tokens=100)
+
+        return self._process_objective(objective)
+
+    async def arun(self, text: str) -> tuple[AnswerType, str]:
+        prompt = self._generate_prompt(text)
+        objective = await self.llm.acompletion(prompt, max_new_tokens=100)
+
+        return self._process_objective(objective)
+
+
+class ToolChainPrompt:
+    """Append-only prompt of an action chain
+
+    The template, tools and objective are rendered once. Every finished step is formatted once
+    and appended to the scratchpad instead of rebuilding the whole prompt on every step.
+    """
+
+    _SCRATCHPAD_MARKER = "\x00agent_scratchpad\x00"
+    _MULTI_ACTION_INSTRUCTION = (
+        "If several independent {tool} steps are needed, write one {tool}/{query} pair "
+        "for each of them before the {observation}. They are run in parallel and their "
+        "results are returned together."
+    )
+
+    def __init__(
+        self,
+        prompt_template: ToolChainTemplate,
+        objective: str,
+        tools: list[BaseTool],
+        multi_action: bool = False,
+    ):
+        self.prompt_template = prompt_template
+
+        tools_prompt = "\n".join(
+            [f"{tool.keywords[0]}: {tool.description}" for tool in tools]
+        )
+
+        # The shipped templates only describe a single action per step
+        if multi_action:
+            tools_prompt += "\n\n" + self._MULTI_ACTION_INSTRUCTION.format(
+                tool=prompt_template.tool_keyword,
+                query=prompt_template.tool_query_keyword,
+                observation=prompt_template.observation_keyword,
+            )
+
+        rendered = prompt_template.template.format(
+            objective=objective,
+            tools_keywords=", ".join([tool.keywords[0] for tool in tools]),
+            tools=tools_prompt,
+            agent_scratchpad=self._SCRATCHPAD_MARKER,
+        )
+
+        self.prefix, _, suffix = rendered.partition(self._SCRATCHPAD_MARKER)
+        self.tail = f"\n{prompt_template.thought_keyword}" + suffix
+
+        self.steps: list[ActionStep] = []
+        self.blocks: list[str] = []
+        self.summarized: set[int] = set()
+        """ Indices of steps whose observation was summarized to fit into the context """
+
+        self._stable: str = self.prefix
+
+    @property
+    def stable_prefix_length(self) -> int:
+        """Number of characters at the start of the prompt which won't change in later steps"""
+
+        return len(self._stable)
+
+    def _format_step(self, step: ActionStep) -> str:
+        thought, action, action_query, observation = step.format()
+
+        return (
+            f"\n{self.prompt_template.thought_keyword}: {thought}"
+            f"\n{self.prompt_template.tool_keyword}: {action}"
+            f"\n{self.prompt_template.tool_query_keyword}: {action_query}"
+            f"\n{self.prompt_template.observation_keyword}: {observation}"
+        )
+
+    def append(self, step: ActionStep):
+        """Add a finished step to the scratchpad"""
+
+        block = self._format_step(step)
+
+        self.steps.append(step)
+        self.blocks.append(block)
+        self._stable += block
+
+    def set_observation(self, i: int, observation: str):
+        """Replace the observation of a previous step (e.g. to shorten the prompt)"""
+
+        self.steps[i].set_observation(observation)
+        self.blocks[i] = self._format_step(self.steps[i])
+        self._stable = self.prefix + "".join(self.blocks)
+
+    def render(self) -> str:
+        """Return the prompt for the next step"""
+
+        return self._stable + self.tail
+
 
 class ToolChainAgent:
     """AutoLLaMa Agent which controls the Action chain"""
@@ -342,6 +819,11 @@ class ToolChainAgent:
         llm: LLMInterface,
         summary_agent: SummaryAgent,
         tools: list[BaseTool],
+        context_budget: ContextBudget = None,
+        multi_action: bool = False,
+        max_parallel_actions: int = 4,
+        prefetch_tools: bool = False,
+        registry: ToolRegistry = None,
         verbose: bool = False,
     ):
         self.name = name
@@ -350,6 +832,13 @@ class ToolChainAgent:
         self.llm = llm
         self.summary_agent = summary_agent
         self.tools = tools
+        self.context_budget = context_budget
+        self.multi_action = multi_action
+        self.max_parallel_actions = max_parallel_actions
+        # A single action ends generation as soon as it is complete, so there is
+        # nothing to overlap with
+        self.prefetch_tools = prefetch_tools and multi_action
+        self.registry = registry or ToolRegistry(tools)
 
     def run(
         self, objective: str, max_iter: int = 10, do_summary: bool = True
@@ -369,51 +858,48 @@ class ToolChainAgent:
         print(f"> Running Agent: {self.name}")
 
         steps: list[ActionStep] = []
+        stop_patterns = self._stop_patterns()
+        chain_prompt = self._generate_prompt(objective)
 
         for i in range(max_iter):
-            if self.verbose:
-                print(f"################# AutoLLaMa Step {i} #################")
+            if self.context_budget:
+                self.context_budget.fit(
+                    chain_prompt,
+                    (lambda text: self.summary_agent.run(objective, text)[1])
+                    if do_summary
+                    else None,
+                )
 
-            # Generate Prompt
-            prompt = self._generate_prompt(objective, steps)
+            prompt = self._start_step(chain_prompt, i)
 
-            if self.verbose:
-                print("Prompting LLM: ----------")
-                print(prompt)
+            with ToolRunner(objective, self.max_parallel_actions) as runner:
+                res = self._generate(
+                    prompt, stop_patterns, runner if self.prefetch_tools else None
+                )
 
-            # Prompt LLM
-            res = self.llm.completion(
-                prompt,
-                stopping_strings=[f"\n{self.prompt_template.observation_keyword}"],
-            )
-
-            if self.verbose:
-                print("Response: ----------")
-                print(res)
-
-            # Parse response
-            step = self._parse_output(res)
+                new_steps = self._process_response(res)
 
-            # Action
-            if step.is_final:
-                print(f"> Final Answer found")
+                if new_steps[0].is_final:
+                    return (AnswerType.CONTEXT, new_steps[0].observation)
 
-                if self.verbose:
-                    print(step.observation)
-
-                return (AnswerType.CONTEXT, step.observation)
+                for step in new_steps:
+                    print(f">> Running Tool: {step.tool.name}")
 
-            print(f">> Running Tool: {step.tool.name}")
-
-            observation = step.tool.run(step.action_query, objective)
+                observations = runner.run(new_steps)
 
             if do_summary:
-                print(f">>> Summarizing Results")
-                _, observation = self.summary_agent.run(step.action_query, observation)
-
-            step.set_observation(observation)
-
-            steps.append(step)
+                print(">>> Summarizing Results")
+                observations = [
+                    summary
+                    for _, summary in self.summary_agent.run_batch(
+                        [
+                            (step.action_query, observation)
+                            for step, observation in zip(new_steps, observations)
+                        ]
+                    )
+                ]
+
+            self._add_steps(chain_prompt, steps, new_steps, observations)
 
         print("> Maximum Iterations Reached - Generating Final Answer")
 
@@ -424,60 +910,192 @@ class ToolChainAgent:
             )[1],
         )
 
-    def _generate_prompt(self, objective: str, steps: list[ActionStep]) -> str:
-        tools_keywords = ", ".join([tool.keywords[0] for tool in self.tools])
-        tools = "\n".join(
-            [f"{tool.keywords[0]}: {tool.description}" for tool in self.tools]
-        )
+    async def arun(
+        self, objective: str, max_iter: int = 10, do_summary: bool = True
+    ) -> tuple[AnswerType, str]:
+        """Execute the action chain without blocking the event loop
+
+        Takes the same arguments and returns the same results as `run`
+        """
 
-        agent_scratchpad = ""
-        for thought, action, action_query, observation in (
-            step.format() for step in steps
-        ):
-            agent_scratchpad += f"\n{self.prompt_template.thought_keyword}: {thought}"
-            agent_scratchpad += f"\n{self.prompt_template.tool_keyword}: {action}"
-            agent_scratchpad += (
-                f"\n{self.prompt_template.tool_query_keyword}: {action_query}"
+        print(f"> Running Agent: {self.name}")
+
+        steps: list[ActionStep] = []
+        stop_patterns = self._stop_patterns()
+        chain_prompt = self._generate_prompt(objective)
+
+        async def summarize(text: str) -> str:
+            return (await self.summary_agent.arun(objective, text))[1]
+
+        for i in range(max_iter):
+            if self.context_budget:
+                await self.context_budget.afit(
+                    chain_prompt, summarize if do_summary else None
+                )
+
+            prompt = self._start_step(chain_prompt, i)
+
+            res = await self.llm.acompletion(
+                prompt, stopping_strings=self._stopping_strings()
             )
-            agent_scratchpad += (
-                f"\n{self.prompt_template.observation_keyword}: {observation}"
+
+            # Apply the early stop of `run` to the complete response
+            stop = LLMInterface._find_stop(res, [], stop_patterns, 0, 0)
+            new_steps = self._process_response(res[:stop])
+
+            if new_steps[0].is_final:
+                return (AnswerType.CONTEXT, new_steps[0].observation)
+
+            for step in new_steps:
+                print(f">> Running Tool: {step.tool.name}")
+
+            observations = await asyncio.gather(
+                *(step.tool.arun(step.action_query, objective) for step in new_steps)
             )
 
-        agent_scratchpad += f"\n{self.prompt_template.thought_keyword}"
+            if do_summary:
+                print(">>> Summarizing Results")
+                observations = [
+                    summary
+                    for _, summary in await self.summary_agent.arun_batch(
+                        [
+                            (step.action_query, observation)
+                            for step, observation in zip(new_steps, observations)
+                        ]
+                    )
+                ]
+
+            self._add_steps(chain_prompt, steps, new_steps, observations)
+
+        print("> Maximum Iterations Reached - Generating Final Answer")
 
-        return self.prompt_template.template.format(
-            objective=objective,
-            tools_keywords=tools_keywords,
-            tools=tools,
-            agent_scratchpad=agent_scratchpad,
+        _, answer = await self.summary_agent.arun(
+            objective, "\n\n".join((step.observation for step in steps))
         )
 
-    def _parse_output(self, output: str) -> ActionStep:
-        """Parse LLM output to ActionStep"""
+        return (AnswerType.CONTEXT, answer)
+
+    def _generate(
+        self, prompt: str, stop_patterns: list[re.Pattern], runner: ToolRunner = None
+    ) -> str:
+        """Stream the response of the LLM
+
+        If a `runner` is given, tools are started as soon as an action is complete,
+        while the LLM is still generating.
+        """
+
+        # Prompt LLM (stops as soon as a complete action input was generated)
+        chunks = self.llm.stream(
+            prompt,
+            stopping_strings=self._stopping_strings(),
+            stop_patterns=stop_patterns,
+        )
+
+        res = ""
+        for chunk in chunks:
+            res += chunk
+
+            if runner is None or "\n" not in chunk:
+                continue
+
+            # Only complete lines can contain a complete action input
+            steps = self._parse_actions(res[: res.rfind("\n")])
+            runner.prefetch(steps if self.multi_action else steps[:1])
+
+        return res
+
+    def _add_steps(
+        self,
+        chain_prompt: ToolChainPrompt,
+        steps: list[ActionStep],
+        new_steps: list[ActionStep],
+        observations: list[str],
+    ):
+        for step, observation in zip(new_steps, observations):
+            step.set_observation(observation)
+
+            steps.append(step)
+            chain_prompt.append(step)
 
-        trunc_output = output.split(self.prompt_template.observation_keyword.lower())[
-            0
-        ].strip()
+    def _stopping_strings(self) -> list[str]:
+        """Strings at which the LLM stops generating a step"""
 
-        if self.prompt_template.final_keyword in trunc_output:
-            return FinalStep(trunc_output.split(self.prompt_template.final_keyword)[-1])
+        # Models often write an observation after every action, which would cut off the
+        # following actions. Generated observations are ignored when parsing.
+        if self.multi_action:
+            return []
 
-        thought_keyword = self.prompt_template.thought_keyword
-        tool_keyword = self.prompt_template.tool_keyword
-        tool_query_keyword = self.prompt_template.tool_query_keyword
+        return [f"\n{self.prompt_template.observation_keyword}"]
 
-        regex = rf"\s*\d*\s*:(.*?)\n{tool_keyword}\s*\d*\s*:(.*?)\n{tool_query_keyword}\s*\d*\s*:[\s]*(.*)"
-        match = re.search(regex, trunc_output, re.DOTALL)
+    def _stop_patterns(self) -> list[re.Pattern]:
+        """Patterns at which the generation of a step can be stopped early"""
 
-        if not match:
-            return FinalStep(trunc_output)
+        # Wait for all actions in multi action mode
+        if self.multi_action:
+            return []
 
-        thought = match.group(1).strip()
-        action = match.group(2).strip()
-        action_query = match.group(3)
+        return [self.prompt_template.parser.action_input_pattern]
 
-        for tool in self.tools:
-            if tool.is_tool(action):
-                return ActionStep(thought, tool, action_query)
+    def _start_step(self, chain_prompt: ToolChainPrompt, i: int) -> str:
+        """Generate the prompt for the next step"""
 
-        return ActionStep(thought, NoneTool(), action_query)
+        if self.verbose:
+            print(f"################# AutoLLaMa Step {i} #################")
+
+        prompt = chain_prompt.render()
+
+        if self.verbose:
+            print("Prompting LLM: ----------")
+            print(prompt)
+
+        return prompt
+
+    def _process_response(self, res: str) -> list[ActionStep]:
+        """Parse the LLM response of a step"""
+
+        if self.verbose:
+            print("Response: ----------")
+            print(res)
+
+        steps = self._parse_actions(res) if self.multi_action else [self._parse_output(res)]
+
+        if steps[0].is_final:
+            print("> Final Answer found")
+
+            if self.verbose:
+                print(steps[0].observation)
+
+        return steps
+
+    def _generate_prompt(self, objective: str) -> ToolChainPrompt:
+        """Render the static part of the prompt for a new action chain
+
+        Every run builds its own prompt, so concurrent runs of one agent don't share
+        their scratchpad.
+        """
+
+        return ToolChainPrompt(
+            self.prompt_template, objective, self.tools, self.multi_action
+        )
+
+    def _parse_output(self, output: str) -> ActionStep:
+        """Parse LLM output to ActionStep"""
+
+        return self._parse_actions(output)[0]
+
+    def _parse_actions(self, output: str) -> list[ActionStep]:
+        """Parse LLM output with one or more Action/Action Input pairs to ActionSteps"""
+
+        parsed = self.prompt_template.parser.parse(output, self.multi_action)
+
+        if parsed.final is not None:
+            return [FinalStep(parsed.final)]
+
+        if not parsed.actions:
+            return [FinalStep(parsed.text)]
+
+        # All actions share the thought in front of the first action
+        return [
+            ActionStep(parsed.thought, self.registry.resolve(action), action_query)
+            for action, action_query in parsed.actions
+        ]
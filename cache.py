@@ -0,0 +1,214 @@
+import os
+import time
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+
+class CacheEntry:
+    """Cached value with its creation time"""
+
+    def __init__(self, value: str, created: float = None):
+        self.value = value
+        self.created = created if created is not None else time.time()
+
+    def age(self) -> float:
+        return time.time() - self.created
+
+
+class CacheStats:
+    """Hit and miss counter of a cache"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __repr__(self) -> str:
+        return f"CacheStats(hits={self.hits}, misses={self.misses}, disk_hits={self.disk_hits}, hit_rate={self.hit_rate:.2f})"
+
+
+class CacheBackend(ABC):
+    """Key value storage for cached strings"""
+
+    @abstractmethod
+    def get(self, key: str) -> CacheEntry | None:
+        raise NotImplementedError("Every cache backend needs to implement `get`")
+
+    @abstractmethod
+    def set(self, key: str, entry: CacheEntry):
+        raise NotImplementedError("Every cache backend needs to implement `set`")
+
+    @abstractmethod
+    def delete(self, key: str):
+        raise NotImplementedError("Every cache backend needs to implement `delete`")
+
+    @abstractmethod
+    def clear(self):
+        raise NotImplementedError("Every cache backend needs to implement `clear`")
+
+
+class MemoryCache(CacheBackend):
+    """In-memory LRU cache limited by number of entries and total size of the values"""
+
+    def __init__(self, max_entries: int = 1024, max_chars: int = 16_000_000):
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> CacheEntry | None:
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+            return entry
+
+    def set(self, key: str, entry: CacheEntry):
+        # Values which don't fit at all would only flush the cache
+        if len(entry.value) > self.max_chars:
+            return
+
+        with self._lock:
+            self._remove(key)
+
+            self._entries[key] = entry
+            self._size += len(entry.value)
+
+            while len(self._entries) > self.max_entries or self._size > self.max_chars:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted.value)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+
+        if entry is not None:
+            self._size -= len(entry.value)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteCache(CacheBackend):
+    """Persistent LRU cache stored in a SQLite database"""
+
+    def __init__(self, path: str, max_entries: int = 100_000):
+        self.path = os.path.abspath(path)
+        self.max_entries = max_entries
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(self.path, check_same_thread=False)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._con.execute(
+            "CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)"
+        )
+        self._con.commit()
+
+    def get(self, key: str) -> CacheEntry | None:
+        with self._lock:
+            row = self._con.execute(
+                "SELECT value, created FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            self._con.execute(
+                "UPDATE cache SET accessed = ? WHERE key = ?", (time.time(), key)
+            )
+            self._con.commit()
+
+        return CacheEntry(row[0], row[1])
+
+    def set(self, key: str, entry: CacheEntry):
+        with self._lock:
+            self._con.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, entry.value, entry.created, time.time()),
+            )
+            self._con.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._con.commit()
+
+    def delete(self, key: str):
+        with self._lock:
+            self._con.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self._con.commit()
+
+    def clear(self):
+        with self._lock:
+            self._con.execute("DELETE FROM cache")
+            self._con.commit()
+
+    def close(self):
+        self._con.close()
+
+
+class TieredCache(CacheBackend):
+    """In-memory LRU cache with an optional persistent second tier"""
+
+    def __init__(self, memory: MemoryCache, disk: CacheBackend = None):
+        self.memory = memory
+        self.disk = disk
+        self.stats = CacheStats()
+
+    def get(self, key: str) -> CacheEntry | None:
+        entry = self.memory.get(key)
+
+        if entry is None and self.disk is not None:
+            entry = self.disk.get(key)
+
+            if entry is not None:
+                self.stats.disk_hits += 1
+                self.memory.set(key, entry)
+
+        if entry is None:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+
+        return entry
+
+    def set(self, key: str, entry: CacheEntry):
+        self.memory.set(key, entry)
+
+        if self.disk is not None:
+            self.disk.set(key, entry)
+
+    def delete(self, key: str):
+        self.memory.delete(key)
+
+        if self.disk is not None:
+            self.disk.delete(key)
+
+    def clear(self):
+        self.memory.clear()
+
+        if self.disk is not None:
+            self.disk.clear()
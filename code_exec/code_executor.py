@@ -1,67 +1,373 @@
 import os
+import json
+import hashlib
+import threading
 from uuid import uuid4
 import subprocess as sp
 import re
+import signal
+import resource
+from typing import Callable
+
+from worker_pool import WorkerPool, WorkerResult, collect_output
+from session import SessionManager
+from code_rewriter import CodeRewriter
+from data_store import DataStore
+from result_cache import ResultCache
+from retention import FileIndex
+
+
+# Runs a script with the same helpers as in the worker pool
+RUNNER = (
+    "import sys, runpy; from worker_pool import script_globals; "
+    "runpy.run_path(sys.argv[1], init_globals=script_globals(), run_name='__main__')"
+)
 
 
 class CodeExecutor:
-    def __init__(self, data_path: str, image_path: str, code_path: str) -> None:
+    def __init__(
+        self,
+        data_path: str,
+        image_path: str,
+        code_path: str,
+        pool_size: int = 2,
+        recycle_after: int = 100,
+        session_idle_timeout: float = 1800,
+        max_sessions: int = 8,
+        session_memory_mb: int = None,
+        max_output: int = 1_000_000,
+        image_format: str = "png",
+        image_dpi: int = 100,
+        preview_rows: int = 20,
+        preview_cols: int = 20,
+        result_cache: ResultCache = None,
+    ) -> None:
+        """
+        ARGUMENTS
+            pool_size (int): Number of warm worker processes. Each script runs in a new subprocess if 0
+            recycle_after (int): Number of scripts after which a worker is replaced
+            session_idle_timeout (float): Seconds after which an unused session is closed
+            max_sessions (int): Maximum number of sessions which are kept at once
+            session_memory_mb (int): Address space limit of each session process (Default: no limit)
+            max_output (int): Number of bytes of stdout and stderr which are kept per script
+            image_format (str): Format in which figures are saved (png, svg, jpg, ...)
+            image_dpi (int): Resolution of saved figures
+            preview_rows (int): Rows of DataFrame previews
+            preview_cols (int): Columns of DataFrame previews
+            result_cache (ResultCache): Cache of successful runs outside of sessions (Default: disabled)
+        """
+
         self.data_path = os.path.abspath(data_path)
         self.image_path = os.path.abspath(image_path)
         self.code_path = os.path.abspath(code_path)
 
-    def _format_code(self, code: str) -> tuple[str, list[str]]:
+        self.data_store = DataStore(self.data_path)
+
+        # Listings of the folders without scanning them on every request
+        self.code_index = FileIndex(self.code_path, ".py")
+        self.image_index = FileIndex(self.image_path)
+        self.data_index = FileIndex(self.data_path)
+        self.result_cache = result_cache
+
+        self.max_output = max_output
+        self.rewriter = CodeRewriter(
+            self.image_path, image_format, image_dpi, preview_rows, preview_cols
+        )
+
+        self.pool_size = pool_size
+        self.recycle_after = recycle_after
+        self._pool: WorkerPool = None
+        self._pool_lock = threading.Lock()
+
+        self.session_idle_timeout = session_idle_timeout
+        self.max_sessions = max_sessions
+        self.session_memory_mb = session_memory_mb
+        self._sessions: SessionManager = None
+
+    def start_pool(self) -> WorkerPool | None:
         """
-        Reformat the code in order to capture outputs like plots or csv files.
+        Start the worker pool (it is started lazily on the first run otherwise)
         """
 
-        formatted_code = ""
+        with self._pool_lock:
+            if self._pool is None and self.pool_size > 0:
+                self._pool = WorkerPool(self.pool_size, self.recycle_after)
 
-        # Replace plt.show() with plt.savefig(f"{image_path}/{uuid4().hex}.png")
-        image_ids = []
+        return self._pool
 
-        for line in code.splitlines():
-            if "plt.show(" in line:
-                id = f"{uuid4().hex}.png"
-                formatted_code += (
-                    re.sub(
-                        r"plt\.show\(\)",
-                        f'plt.savefig("{self.image_path}/{id}")',
-                        line,
-                    )
-                    + "\n"
+    @property
+    def sessions(self) -> SessionManager:
+        with self._pool_lock:
+            if self._sessions is None:
+                self._sessions = SessionManager(
+                    self.session_idle_timeout, self.max_sessions, self.session_memory_mb
                 )
 
-                image_ids.append(id)
-            else:
-                formatted_code += line + "\n"
+        return self._sessions
+
+    def _format_code(self, code: str) -> str:
+        """
+        Instrument the code in order to capture outputs like plots or DataFrame previews.
+        """
+
+        return self.rewriter.rewrite(code)
+
+    def _collect_images(self, id: str) -> list[str]:
+        """
+        Names of the images which were saved by a script (numbered in the order they were saved)
+        """
+
+        images = []
+
+        while True:
+            name = f"{id}_{len(images)}.{self.rewriter.image_format}"
 
-        return (formatted_code, image_ids)
+            if not os.path.exists(os.path.join(self.image_path, name)):
+                return images
 
-    def _exec_code(self, code: str, id: str) -> str:
+            self.image_index.add(name)
+            images.append(name)
+
+    def _run_subprocess(
+        self,
+        file_path: str,
+        timeout: float = None,
+        cpu_limit: int = None,
+        output_path: str = None,
+        on_start: Callable[[int], None] = None,
+    ) -> WorkerResult:
         """
-        Execute provided code
+        Execute a script in a new interpreter (used without worker pool)
         """
 
-        file_path = os.path.join(self.code_path, f"{id}.py")
+        def set_limits():
+            if cpu_limit:
+                resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 1))
+
+        proc = sp.Popen(
+            ["python3", "-c", RUNNER, file_path],
+            cwd=self.data_path,
+            env={**os.environ, "PYTHONPATH": os.path.dirname(os.path.abspath(__file__))},
+            stdout=sp.PIPE,
+            stderr=sp.PIPE,
+            preexec_fn=set_limits,
+        )
+
+        if on_start is not None:
+            on_start(proc.pid)
+
+        stdout, stderr, timed_out = collect_output(
+            proc.stdout, proc.stderr, timeout, proc.kill, self.max_output, output_path
+        )
+        proc.wait()
+
+        return WorkerResult(
+            proc.returncode,
+            stdout.getvalue(),
+            stderr.getvalue(),
+            timed_out,
+            stdout.truncated or stderr.truncated,
+        )
+
+    def execute(
+        self,
+        code: str,
+        id: str,
+        session: str = None,
+        timeout: float = None,
+        cpu_limit: int = None,
+        output_path: str = None,
+        on_start: Callable[[int], None] = None,
+    ) -> WorkerResult:
+        """
+        Write the (formatted) code to a file and execute it
+
+        ARGUMENTS
+            session (str): Run in the persistent namespace of this session
+            timeout (float): Wall-clock limit in seconds
+            cpu_limit (int): CPU time limit in seconds (not supported in sessions)
+            output_path (str): Prefix of the files which receive stdout and stderr while the code runs
+            on_start (Callable[[int], None]): Called with the PID of the script process
+        """
+
+        file_path = self._code_file(id)
 
         # Create file and write code to it
         with open(file_path, mode="x") as f:
             f.write(code)
 
-        # Execute code and capture output
-        res = sp.check_output(["python3", file_path], cwd=self.data_path)
+        self.code_index.add(os.path.basename(file_path))
+
+        if session is not None:
+            return self.sessions.run(
+                session, file_path, self.data_path, timeout, self.max_output, output_path
+            )
+
+        pool = self.start_pool()
+
+        if pool is None:
+            return self._run_subprocess(
+                file_path, timeout, cpu_limit, output_path, on_start
+            )
+
+        return pool.run(
+            file_path,
+            self.data_path,
+            timeout,
+            cpu_limit,
+            self.max_output,
+            output_path,
+            on_start,
+        )
 
-        return res.decode("utf-8")
+    def _code_file(self, id: str) -> str:
+        return os.path.join(self.code_path, f"{id}.py")
 
-    def run(self, code: str):
+    def parse_error(self, id: str, res: WorkerResult, timeout: float = None) -> dict | None:
+        """
+        Describe why a script failed
+
+        RETURNS
+            error (dict | None): Type, message, line in the script and traceback of the error
+        """
+
+        if res.returncode == 0 and not res.timed_out:
+            return None
+
+        if res.timed_out:
+            return {
+                "type": "TimeoutError",
+                "message": f"Execution exceeded the time limit of {timeout} seconds",
+                "line": None,
+                "traceback": None,
+            }
+
+        if res.returncode == -signal.SIGXCPU:
+            return {
+                "type": "TimeoutError",
+                "message": "Execution exceeded the CPU time limit",
+                "line": None,
+                "traceback": None,
+            }
+
+        stderr = res.stderr.decode("utf-8", errors="replace")
+        header = "Traceback (most recent call last):\n"
+        start = stderr.rfind(header)
+        tb = stderr[start:] if start >= 0 else (stderr or None)
+
+        # Drop the frames of the worker which ran the script
+        script_frame = f'  File "{self._code_file(id)}"'
+        if tb is not None and start >= 0 and script_frame in tb:
+            tb = header + tb[tb.index(script_frame) :]
+
+        if res.returncode < 0:
+            error_type = "Killed"
+            message = f"Process was killed by {signal.Signals(-res.returncode).name}"
+        else:
+            last_line = next(
+                (line for line in reversed(stderr.splitlines()) if line.strip()), ""
+            )
+            error_type, _, message = last_line.partition(": ")
+
+            if not re.fullmatch(r"[\w.]+", error_type):
+                error_type, message = "Error", last_line
+
+        lines = re.findall(
+            rf'File "{re.escape(self._code_file(id))}", line (\d+)', stderr
+        )
+
+        return {
+            "type": error_type,
+            "message": message,
+            "line": int(lines[-1]) if lines else None,
+            "traceback": tb,
+        }
+
+    def result(self, id: str, res: WorkerResult, timeout: float = None) -> dict:
+        """
+        Response of an executed script
+        """
+
+        return {
+            "id": id,
+            "response": res.stdout.decode("utf-8", errors="replace"),
+            "stderr": res.stderr.decode("utf-8", errors="replace"),
+            "images": self._collect_images(id),
+            "returncode": res.returncode,
+            "truncated": res.truncated,
+            "error": self.parse_error(id, res, timeout),
+            "variables": res.variables,
+            "cached": False,
+        }
+
+    def lookup(
+        self, code: str, session: str = None, epoch: str | int = None
+    ) -> tuple[str | None, dict | None]:
+        """
+        Look up the result of formatted code run over the current data files.
+        Runs in a session are only cached if the client sends an `epoch` which
+        identifies the state of the session (e.g. the turn of a chat), so a retry
+        from the same state hits.
+
+        RETURNS
+            key (str | None): Key under which the result should be stored (None if it can't be cached)
+            result (dict | None): Stored result
+        """
+
+        # Results in a session depend on the state of previous runs
+        if self.result_cache is None or (session is not None and epoch is None):
+            return (None, None)
+
+        digest = hashlib.sha256(code.encode("utf-8"))
+        digest.update(json.dumps(sorted(self.data_store.hashes().items())).encode("utf-8"))
+
+        if session is not None:
+            instance = self.sessions.get(session).instance
+            digest.update(json.dumps([session, instance, epoch]).encode("utf-8"))
+
+        key = digest.hexdigest()
+
+        result = self.result_cache.get(key)
+
+        return (key, None if result is None else {**result, "cached": True})
+
+    def store(self, key: str | None, result: dict):
+        """
+        Store the result of a successful run under the key returned by `lookup`
+        """
+
+        if key is None or result["error"] is not None or result["truncated"]:
+            return
+
+        files = [self._code_file(result["id"])] + [
+            os.path.join(self.image_path, image) for image in result["images"]
+        ]
+        self.result_cache.set(key, result, files)
+
+    def run(
+        self,
+        code: str,
+        session: str = None,
+        timeout: float = None,
+        use_cache: bool = True,
+        epoch: str | int = None,
+    ):
         """
         Format and execute the given code. Return ouput data and text.
+        If a session is given, the code runs in the persistent namespace of that session.
+        Session runs are only cached if `epoch` is given (see `lookup`).
+        Failed scripts are reported in the "error" field of the result.
         """
 
         id = uuid4().hex
+        code = self._format_code(code)
+
+        key, cached = self.lookup(code, session, epoch) if use_cache else (None, None)
+        if cached is not None:
+            return cached
 
-        code, image_ids = self._format_code(code)
-        out = self._exec_code(code, id)
+        res = self.execute(code, id, session, timeout)
+        result = self.result(id, res, timeout)
+        self.store(key, result)
 
-        return {"id": id, "response": out, "images": image_ids}
+        return result
@@ -0,0 +1,44 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+
+def load_table(name: str, columns: list[str] = None) -> pa.Table:
+    """Load a data file as Arrow table
+
+    Arrow IPC and uncompressed Feather files are memory-mapped, so their buffers are
+    only read when they are accessed.
+    """
+
+    file_type = os.path.splitext(name)[1].lower().lstrip(".")
+
+    if file_type in ("arrow", "feather"):
+        try:
+            table = pa.ipc.open_file(pa.memory_map(name)).read_all()
+        except pa.ArrowInvalid:
+            table = feather.read_table(name, memory_map=True)
+
+        return table.select(columns) if columns else table
+
+    if file_type == "parquet":
+        return pq.read_table(name, columns=columns, memory_map=True)
+
+    if file_type == "csv":
+        return pa.Table.from_pandas(pd.read_csv(name, usecols=columns))
+
+    raise ValueError(f"Unsupported file type {file_type}")
+
+
+def load_data(name: str, columns: list[str] = None) -> pd.DataFrame:
+    """Load a data file as pandas DataFrame
+
+    Columnar files are converted from Arrow without copying where the data types allow it.
+    """
+
+    if name.lower().endswith(".csv"):
+        return pd.read_csv(name, usecols=columns)
+
+    return load_table(name, columns).to_pandas(split_blocks=True, self_destruct=True)
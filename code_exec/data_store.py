@@ -0,0 +1,151 @@
+import os
+import hashlib
+import threading
+from uuid import uuid4
+from typing import BinaryIO
+
+from werkzeug.utils import secure_filename
+
+
+class DataStore:
+    """Data files of the executor identified by the SHA-256 of their content
+
+    Uploading a file which already exists under the same name is a no-op. If the same
+    content exists under another name, it is hard linked instead of stored twice.
+    """
+
+    def __init__(self, path: str, chunk_size: int = 1024 * 1024):
+        self.path = os.path.abspath(path)
+        self.chunk_size = chunk_size
+
+        # Hashes are only computed again if size or modification time change
+        self._hashes: dict[str, tuple[tuple[int, int], str]] = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(self.path, exist_ok=True)
+
+    def file_path(self, name: str) -> str:
+        name = secure_filename(name)
+
+        if not name:
+            raise ValueError("Invalid file name")
+
+        return os.path.join(self.path, name)
+
+    def info(self, name: str) -> dict | None:
+        """Return name, size and hash of a stored file"""
+
+        path = self.file_path(name)
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        return {
+            "name": os.path.basename(path),
+            "size": stat.st_size,
+            "sha256": self._hash(path, stat),
+        }
+
+    def hashes(self) -> dict[str, str]:
+        """Return the hashes of all stored files by name"""
+
+        hashes = {}
+
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+
+                hashes[entry.name] = self._hash(entry.path, entry.stat())
+
+        return hashes
+
+    def put(self, name: str, stream: BinaryIO, sha256: str = None) -> dict:
+        """Store the content of a stream under the given name
+
+        ARGUMENTS
+            sha256 (str): Expected hash of the content, the upload is rejected if it differs
+
+        RETURNS
+            info (dict): Name, size and hash of the file and whether it was changed
+        """
+
+        path = self.file_path(name)
+        tmp = os.path.join(self.path, f".upload-{uuid4().hex}")
+
+        digest = hashlib.sha256()
+        size = 0
+
+        try:
+            with open(tmp, "wb") as f:
+                while chunk := stream.read(self.chunk_size):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+
+            content_hash = digest.hexdigest()
+
+            if sha256 is not None and sha256.lower() != content_hash:
+                raise ValueError(f"Hash mismatch: expected {sha256}, got {content_hash}")
+
+            info = {"name": os.path.basename(path), "size": size, "sha256": content_hash}
+
+            current = self.info(name)
+            if current is not None and current["sha256"] == content_hash:
+                return {**info, "changed": False}
+
+            duplicate = self._find(content_hash)
+            if duplicate is not None and duplicate != path:
+                os.remove(tmp)
+                os.link(duplicate, tmp)
+
+            os.replace(tmp, path)
+            self._hash(path, os.stat(path), content_hash)
+
+            return {**info, "changed": True}
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _find(self, content_hash: str) -> str | None:
+        """Return the path of a known file with the given hash"""
+
+        with self._lock:
+            candidates = [
+                path for path, (_, h) in self._hashes.items() if h == content_hash
+            ]
+
+        for path in candidates:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+
+            if self._hash(path, stat) == content_hash:
+                return path
+
+        return None
+
+    def _hash(self, path: str, stat: os.stat_result, content_hash: str = None) -> str:
+        key = (stat.st_size, stat.st_mtime_ns)
+
+        with self._lock:
+            cached = self._hashes.get(path)
+
+        if content_hash is None:
+            if cached is not None and cached[0] == key:
+                return cached[1]
+
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                while chunk := f.read(self.chunk_size):
+                    digest.update(chunk)
+
+            content_hash = digest.hexdigest()
+
+        with self._lock:
+            self._hashes[path] = (key, content_hash)
+
+        return content_hash
@@ -0,0 +1,71 @@
+import os
+import sys
+from itertools import count
+
+# Number of images saved per script
+_counters: dict[str, count] = {}
+
+
+def image_prefix(file_path: str) -> str:
+    """Images of a script are named after its id"""
+
+    return os.path.splitext(os.path.basename(file_path))[0]
+
+
+def _save(fig, file_path: str, image_path: str, fmt: str, dpi: int):
+    prefix = image_prefix(file_path)
+    n = next(_counters.setdefault(prefix, count()))
+
+    fig.savefig(os.path.join(image_path, f"{prefix}_{n}.{fmt}"), format=fmt, dpi=dpi)
+
+
+class _Shown:
+    """Stands in for an object whose figure was saved, so its `show` call does nothing"""
+
+    def show(self, *args, **kwargs):
+        return None
+
+
+_SHOWN = _Shown()
+
+
+def show(obj, file_path: str, image_path: str, fmt: str = "png", dpi: int = 100):
+    """Called on the object of `plt.show()`, `fig.show()` and similar calls
+
+    Figures are saved into the image folder and closed. If `obj` is None or pyplot,
+    all open figures are saved. Other objects are returned, so their own `show` runs.
+    """
+
+    plt = sys.modules.get("matplotlib.pyplot")
+
+    if plt is None:
+        return obj if obj is not None else _SHOWN
+
+    if obj is None or obj is plt:
+        for num in plt.get_fignums():
+            _save(plt.figure(num), file_path, image_path, fmt, dpi)
+
+        plt.close("all")
+        return _SHOWN
+
+    if isinstance(obj, plt.Figure):
+        _save(obj, file_path, image_path, fmt, dpi)
+        plt.close(obj)
+        return _SHOWN
+
+    return obj
+
+
+def display(value, max_rows: int = 20, max_cols: int = 20):
+    """Print a bounded preview of DataFrames which are evaluated as a statement"""
+
+    pd = sys.modules.get("pandas")
+
+    if pd is None:
+        return
+
+    if isinstance(value, pd.DataFrame):
+        print(value.to_string(max_rows=max_rows, max_cols=max_cols))
+        print(f"[{value.shape[0]} rows x {value.shape[1]} columns]")
+    elif isinstance(value, pd.Series):
+        print(value.to_string(max_rows=max_rows))
@@ -0,0 +1,277 @@
+import os
+import time
+import signal
+import threading
+from enum import Enum
+from uuid import uuid4
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from code_executor import CodeExecutor
+from worker_pool import WorkerResult
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    TIMEOUT = "timeout"
+    CANCELLED = "cancelled"
+
+
+STREAMS = ["stdout", "stderr"]
+FINISHED = {JobStatus.DONE, JobStatus.FAILED, JobStatus.TIMEOUT, JobStatus.CANCELLED}
+
+
+class Job:
+    """Code submitted to the job queue"""
+
+    def __init__(
+        self,
+        code: str,
+        output_path: str,
+        session: str = None,
+        timeout: float = None,
+        cpu_limit: int = None,
+        use_cache: bool = True,
+        epoch: str | int = None,
+    ):
+        self.id = uuid4().hex
+        self.code = code
+        self.output_path = os.path.join(output_path, self.id)
+        self.session = session
+        self.timeout = timeout
+        self.cpu_limit = cpu_limit
+        self.use_cache = use_cache
+        self.epoch = epoch
+
+        self.status = JobStatus.QUEUED
+        self.created = time.time()
+        self.started: float = None
+        self.finished: float = None
+
+        self.result: dict = None
+
+        self.pid: int = None
+        self.future: Future = None
+        self.lock = threading.Lock()
+
+        # Create the files right away, so output can be polled before the job starts
+        for stream in STREAMS:
+            open(self.output_file(stream), "wb").close()
+
+    def output_file(self, stream: str) -> str:
+        return f"{self.output_path}.{stream}"
+
+    def read_output(
+        self, offset: int = 0, stream: str = "stdout", max_bytes: int = 65536
+    ) -> tuple[str, int]:
+        """Read output written to `stream` since `offset`
+
+        RETURNS
+            output (str): New output
+            offset (int): Offset for the next read
+        """
+
+        try:
+            with open(self.output_file(stream), "rb") as f:
+                f.seek(offset)
+                data = f.read(max_bytes)
+        except FileNotFoundError:
+            return ("", offset)
+
+        # Don't split multi-byte characters between two reads
+        for cut in range(min(4, len(data) + 1)):
+            try:
+                text = data[: len(data) - cut].decode("utf-8")
+                return (text, offset + len(data) - cut)
+            except UnicodeDecodeError:
+                continue
+
+        return (data.decode("utf-8", errors="replace"), offset + len(data))
+
+    def info(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status.value,
+            "session": self.session,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "result": self.result,
+        }
+
+
+class JobQueue:
+    """Runs submitted code in the background on a bounded number of threads
+
+    Every job has a wall-clock and CPU time limit and can be cancelled while it runs.
+    Only the last `max_finished` finished jobs are kept.
+    """
+
+    def __init__(
+        self,
+        code_exec: CodeExecutor,
+        output_path: str,
+        max_workers: int = 2,
+        max_finished: int = 100,
+        default_timeout: float = 300,
+        max_timeout: float = 3600,
+    ):
+        self.code_exec = code_exec
+        self.output_path = os.path.abspath(output_path)
+        self.max_finished = max_finished
+        self.default_timeout = default_timeout
+        self.max_timeout = max_timeout
+
+        os.makedirs(self.output_path, exist_ok=True)
+
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="job")
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        code: str,
+        session: str = None,
+        timeout: float = None,
+        cpu_limit: int = None,
+        use_cache: bool = True,
+        epoch: str | int = None,
+    ) -> Job:
+        timeout = min(timeout or self.default_timeout, self.max_timeout)
+        cpu_limit = int(cpu_limit) if cpu_limit else None
+
+        job = Job(
+            code, self.output_path, session, timeout, cpu_limit, use_cache, epoch
+        )
+
+        with self._lock:
+            self._jobs[job.id] = job
+            self._evict()
+
+        job.future = self._executor.submit(self._run, job)
+        return job
+
+    def get(self, id: str) -> Job | None:
+        with self._lock:
+            return self._jobs.get(id)
+
+    def list(self) -> list[dict]:
+        with self._lock:
+            return [
+                {"id": job.id, "status": job.status.value, "created": job.created}
+                for job in self._jobs.values()
+            ]
+
+    def cancel(self, id: str) -> bool:
+        """Cancel a queued job or kill a running one"""
+
+        job = self.get(id)
+
+        if job is None:
+            return False
+
+        with job.lock:
+            if job.status in FINISHED:
+                return False
+
+            if job.status == JobStatus.QUEUED and job.future.cancel():
+                self._finish(job, JobStatus.CANCELLED)
+                return True
+
+            job.status = JobStatus.CANCELLED
+
+            if job.session is not None:
+                # Code can't be interrupted inside a session without losing it
+                self.code_exec.sessions.reset(job.session)
+            elif job.pid is not None:
+                try:
+                    os.kill(job.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+        return True
+
+    def _run(self, job: Job):
+        with job.lock:
+            if job.status != JobStatus.QUEUED:
+                # Cancelled right before it was picked up
+                self._finish(job, JobStatus.CANCELLED)
+                return
+
+            job.status = JobStatus.RUNNING
+            job.started = time.time()
+
+        def on_start(pid: int):
+            with job.lock:
+                job.pid = pid
+
+                if job.status == JobStatus.CANCELLED:
+                    os.kill(pid, signal.SIGKILL)
+
+        code = self.code_exec._format_code(job.code)
+        key, cached = (
+            self.code_exec.lookup(code, job.session, job.epoch)
+            if job.use_cache
+            else (None, None)
+        )
+
+        if cached is not None:
+            with open(job.output_file("stdout"), "w") as f:
+                f.write(cached["response"])
+
+            with job.lock:
+                job.result = cached
+                self._finish(job, JobStatus.DONE)
+
+            return
+
+        try:
+            res = self.code_exec.execute(
+                code,
+                job.id,
+                job.session,
+                job.timeout,
+                job.cpu_limit,
+                job.output_path,
+                on_start,
+            )
+        except Exception as err:
+            res = WorkerResult(1, b"", f"{type(err).__name__}: {err}".encode("utf-8"))
+
+        with job.lock:
+            job.pid = None
+            job.result = self.code_exec.result(job.id, res, job.timeout)
+
+            if job.status == JobStatus.CANCELLED:
+                status = JobStatus.CANCELLED
+            elif res.timed_out or res.returncode == -signal.SIGXCPU:
+                status = JobStatus.TIMEOUT
+            elif res.returncode != 0:
+                status = JobStatus.FAILED
+            else:
+                status = JobStatus.DONE
+                self.code_exec.store(key, job.result)
+
+            self._finish(job, status)
+
+    def _finish(self, job: Job, status: JobStatus):
+        job.status = status
+        job.finished = time.time()
+
+    def _evict(self):
+        finished = [id for id, job in self._jobs.items() if job.status in FINISHED]
+
+        for id in finished[: max(0, len(finished) - self.max_finished)]:
+            job = self._jobs.pop(id)
+
+            for stream in STREAMS:
+                try:
+                    os.remove(job.output_file(stream))
+                except FileNotFoundError:
+                    pass
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+
+class ResultCache:
+    """Persistent LRU cache of execution results
+
+    Every entry owns the code file and images of its run. They are deleted together with
+    the entry when the cache exceeds `max_entries` or `max_bytes`, and an entry whose
+    files were removed by someone else counts as a miss.
+    """
+
+    def __init__(
+        self, path: str, max_entries: int = 1000, max_bytes: int = 512 * 1024 * 1024
+    ):
+        self.path = os.path.abspath(path)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(self.path, check_same_thread=False)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute(
+            "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result TEXT NOT NULL, files TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._con.execute(
+            "CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)"
+        )
+        self._con.commit()
+
+    def get(self, key: str) -> dict | None:
+        with self._lock:
+            row = self._con.execute(
+                "SELECT result, files FROM results WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            if not all(os.path.exists(path) for path in json.loads(row[1])):
+                self._delete(key, json.loads(row[1]))
+                self._con.commit()
+                return None
+
+            self._con.execute(
+                "UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key)
+            )
+            self._con.commit()
+
+        return json.loads(row[0])
+
+    def set(self, key: str, result: dict, files: list[str]):
+        data = json.dumps(result)
+        size = len(data) + sum(
+            os.path.getsize(path) for path in files if os.path.exists(path)
+        )
+
+        with self._lock:
+            self._con.execute(
+                "INSERT OR REPLACE INTO results (key, result, files, size, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, data, json.dumps(files), size, time.time()),
+            )
+            self._evict()
+            self._con.commit()
+
+    def clear(self):
+        with self._lock:
+            rows = self._con.execute("SELECT key, files FROM results").fetchall()
+
+            for key, files in rows:
+                self._delete(key, json.loads(files))
+
+            self._con.commit()
+
+    def _evict(self):
+        count, total = self._con.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results"
+        ).fetchone()
+
+        rows = self._con.execute(
+            "SELECT key, files, size FROM results ORDER BY accessed ASC"
+        )
+
+        for key, files, size in rows.fetchall():
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+
+            self._delete(key, json.loads(files))
+            count -= 1
+            total -= size
+
+    def _delete(self, key: str, files: list[str]):
+        self._con.execute("DELETE FROM results WHERE key = ?", (key,))
+
+        for path in files:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        self._con.close()
@@ -0,0 +1,200 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from itertools import islice
+
+
+class RetentionPolicy:
+    """Limits for the files in a folder. A limit of None is not enforced"""
+
+    def __init__(
+        self, max_age: float = None, max_bytes: int = None, max_files: int = None
+    ):
+        """
+        ARGUMENTS
+            max_age (float): Seconds after which a file is removed
+            max_bytes (int): Maximum total size of the files
+            max_files (int): Maximum number of files
+        """
+
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+
+
+class FileIndex:
+    """In-memory index of the files in a folder, ordered from oldest to newest
+
+    The folder is scanned once on first use and again by the sweeper. Files written by
+    the executor are added directly, so listings never scan the folder.
+    """
+
+    def __init__(self, path: str, suffix: str = ""):
+        self.path = os.path.abspath(path)
+        self.suffix = suffix
+
+        # name -> (size, modification time)
+        self._files: OrderedDict[str, tuple[int, float]] = None
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def rescan(self):
+        """Rebuild the index from the folder"""
+
+        files = []
+
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.name.endswith(self.suffix):
+                    continue
+
+                try:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files.append((entry.name, stat.st_size, stat.st_mtime))
+                except FileNotFoundError:
+                    continue
+
+        files.sort(key=lambda file: file[2])
+
+        with self._lock:
+            self._files = OrderedDict(
+                (name, (size, mtime)) for name, size, mtime in files
+            )
+            self._bytes = sum(size for _, size, _ in files)
+
+    def _ensure(self):
+        if self._files is None:
+            self.rescan()
+
+    def add(self, name: str):
+        """Add a new file to the index"""
+
+        self._ensure()
+
+        try:
+            stat = os.stat(os.path.join(self.path, name))
+        except FileNotFoundError:
+            return
+
+        with self._lock:
+            self._remove(name)
+            self._files[name] = (stat.st_size, stat.st_mtime)
+            self._bytes += stat.st_size
+
+    def clear(self):
+        with self._lock:
+            self._files = OrderedDict()
+            self._bytes = 0
+
+    def _remove(self, name: str):
+        entry = self._files.pop(name, None)
+
+        if entry is not None:
+            self._bytes -= entry[0]
+
+    def page(self, offset: int = 0, limit: int = 100) -> tuple[list[str], int]:
+        """Return the names of one page of files, newest first
+
+        RETURNS
+            names (list[str]): Names of the files on the page
+            total (int): Number of files in the folder
+        """
+
+        self._ensure()
+
+        with self._lock:
+            names = list(islice(reversed(self._files), offset, offset + limit))
+            return (names, len(self._files))
+
+    def stats(self) -> dict:
+        self._ensure()
+
+        with self._lock:
+            return {"files": len(self._files), "bytes": self._bytes}
+
+    def sweep(self, policy: RetentionPolicy) -> list[str]:
+        """Delete the oldest files until the folder satisfies the policy
+
+        RETURNS
+            removed (list[str]): Names of the deleted files
+        """
+
+        self._ensure()
+
+        now = time.time()
+        expired = []
+
+        with self._lock:
+            files, size = len(self._files), self._bytes
+
+            for name, (file_size, mtime) in self._files.items():
+                if not (
+                    (policy.max_age is not None and now - mtime > policy.max_age)
+                    or (policy.max_files is not None and files > policy.max_files)
+                    or (policy.max_bytes is not None and size > policy.max_bytes)
+                ):
+                    break
+
+                expired.append(name)
+                files -= 1
+                size -= file_size
+
+            for name in expired:
+                self._remove(name)
+
+        for name in expired:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+        return expired
+
+
+class Sweeper:
+    """Background thread which applies retention policies to file indexes"""
+
+    def __init__(
+        self, indexes: list[tuple[FileIndex, RetentionPolicy]], interval: float = 300
+    ):
+        self.indexes = indexes
+        self.interval = interval
+
+        self._stop = threading.Event()
+        self._thread: threading.Thread = None
+
+    def run_once(self) -> int:
+        """Rescan all folders and apply their policies. Return the number of deleted files"""
+
+        removed = 0
+
+        for index, policy in self.indexes:
+            # Picks up files which weren't written by the executor
+            index.rescan()
+            removed += len(index.sweep(policy))
+
+        return removed
+
+    def _run(self):
+        while True:
+            try:
+                removed = self.run_once()
+
+                if removed:
+                    logging.info(f"Sweeper removed {removed} files")
+            except OSError as err:
+                logging.warning(f"Sweep failed: {err}")
+
+            if self._stop.wait(self.interval):
+                break
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
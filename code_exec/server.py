@@ -1,11 +1,15 @@
 import os
+import json
+import time
 import shutil
 import logging
-from glob import iglob
 
-from flask import Flask, request, abort, send_file
+from flask import Flask, Response, request, abort, send_file, stream_with_context
 
 from code_executor import CodeExecutor
+from jobs import JobQueue, STREAMS, FINISHED
+from result_cache import ResultCache
+from retention import FileIndex, RetentionPolicy, Sweeper
 
 app = Flask("code_exec")
 
@@ -20,8 +24,83 @@ else:
 IMAGE_PATH = "static/images"
 DATA_PATH = "static/files"
 CODE_PATH = "static/code"
+RESULT_CACHE_PATH = "static/cache/results.sqlite"
+JOB_PATH = "static/jobs"
+
+POOL_SIZE = int(os.environ.get("CODE_EXEC_POOL_SIZE", 2))
+RECYCLE_AFTER = int(os.environ.get("CODE_EXEC_RECYCLE_AFTER", 100))
+SESSION_IDLE_TIMEOUT = float(os.environ.get("CODE_EXEC_SESSION_IDLE_TIMEOUT", 1800))
+MAX_SESSIONS = int(os.environ.get("CODE_EXEC_MAX_SESSIONS", 8))
+SESSION_MEMORY_MB = int(os.environ.get("CODE_EXEC_SESSION_MEMORY_MB", 0)) or None
+JOB_WORKERS = int(os.environ.get("CODE_EXEC_JOB_WORKERS", 2))
+JOB_TIMEOUT = float(os.environ.get("CODE_EXEC_JOB_TIMEOUT", 300))
+JOB_MAX_TIMEOUT = float(os.environ.get("CODE_EXEC_JOB_MAX_TIMEOUT", 3600))
+MAX_OUTPUT = int(os.environ.get("CODE_EXEC_MAX_OUTPUT", 1_000_000))
+IMAGE_FORMAT = os.environ.get("CODE_EXEC_IMAGE_FORMAT", "png")
+IMAGE_DPI = int(os.environ.get("CODE_EXEC_IMAGE_DPI", 100))
+RESULT_CACHE = os.environ.get("CODE_EXEC_RESULT_CACHE", "0") == "1"
+RESULT_CACHE_ENTRIES = int(os.environ.get("CODE_EXEC_RESULT_CACHE_ENTRIES", 1000))
+RESULT_CACHE_MB = int(os.environ.get("CODE_EXEC_RESULT_CACHE_MB", 512))
+RETENTION_MAX_AGE = float(os.environ.get("CODE_EXEC_RETENTION_MAX_AGE", 7 * 24 * 3600))
+RETENTION_MAX_MB = int(os.environ.get("CODE_EXEC_RETENTION_MAX_MB", 1024))
+RETENTION_MAX_FILES = int(os.environ.get("CODE_EXEC_RETENTION_MAX_FILES", 10_000))
+SWEEP_INTERVAL = float(os.environ.get("CODE_EXEC_SWEEP_INTERVAL", 300))
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+EVENT_INTERVAL = 0.2
+
+code_exec = CodeExecutor(
+    DATA_PATH,
+    IMAGE_PATH,
+    CODE_PATH,
+    pool_size=POOL_SIZE,
+    recycle_after=RECYCLE_AFTER,
+    session_idle_timeout=SESSION_IDLE_TIMEOUT,
+    max_sessions=MAX_SESSIONS,
+    session_memory_mb=SESSION_MEMORY_MB,
+    max_output=MAX_OUTPUT,
+    image_format=IMAGE_FORMAT,
+    image_dpi=IMAGE_DPI,
+    result_cache=ResultCache(
+        RESULT_CACHE_PATH, RESULT_CACHE_ENTRIES, RESULT_CACHE_MB * 1024 * 1024
+    )
+    if RESULT_CACHE
+    else None,
+)
+
+data_store = code_exec.data_store
+
+retention = RetentionPolicy(
+    RETENTION_MAX_AGE, RETENTION_MAX_MB * 1024 * 1024, RETENTION_MAX_FILES
+)
+sweeper = Sweeper(
+    [
+        (code_exec.code_index, retention),
+        (code_exec.image_index, retention),
+        # Only rescanned, data is never removed automatically
+        (code_exec.data_index, RetentionPolicy()),
+    ],
+    interval=SWEEP_INTERVAL,
+)
+
+jobs = JobQueue(
+    code_exec,
+    JOB_PATH,
+    max_workers=JOB_WORKERS,
+    default_timeout=JOB_TIMEOUT,
+    max_timeout=JOB_MAX_TIMEOUT,
+)
+
+
+def page(index: FileIndex) -> tuple[list[str], int]:
+    """
+    Page of an index selected by the offset and limit query parameters
+    """
+
+    offset = max(0, request.args.get("offset", 0, type=int))
+    limit = min(max(1, request.args.get("limit", PAGE_SIZE, type=int)), MAX_PAGE_SIZE)
 
-code_exec = CodeExecutor(DATA_PATH, IMAGE_PATH, CODE_PATH)
+    return index.page(offset, limit)
 
 
 @app.route("/", methods=["POST"])
@@ -39,18 +118,150 @@ def execute_code():
     except KeyError:
         abort(400, message="Missing required parameter")
 
-    return code_exec.run(code)
+    return code_exec.run(
+        code,
+        session=req.get("session"),
+        use_cache=req.get("cache", True),
+        epoch=req.get("epoch"),
+    )
+
+
+@app.route("/job", methods=["POST"])
+def submit_job():
+    """
+    Queue code for execution and return the job id immediately
+    """
+
+    req = request.get_json()
+
+    try:
+        code = req["code"]
+    except KeyError:
+        abort(400, message="Missing required parameter")
+
+    job = jobs.submit(
+        code,
+        session=req.get("session"),
+        timeout=req.get("timeout"),
+        cpu_limit=req.get("cpu_limit"),
+        use_cache=req.get("cache", True),
+        epoch=req.get("epoch"),
+    )
+
+    return job.info()
+
+
+@app.route("/job", methods=["GET"])
+def list_jobs():
+    """
+    List queued, running and recently finished jobs
+    """
+
+    return {"jobs": jobs.list()}
+
+
+@app.route("/job/<id>", methods=["GET", "DELETE"])
+def job_status(id: str):
+    """
+    Return the status of a job (and cancel it)
+    """
+
+    job = jobs.get(id)
+
+    if job is None:
+        abort(404)
+
+    cancelled = request.method == "DELETE" and jobs.cancel(id)
+
+    return {**job.info(), "cancelled": cancelled}
+
+
+@app.route("/job/<id>/output", methods=["GET"])
+def job_output(id: str):
+    """
+    Return the stdout of a job written after the given byte offset
+    """
+
+    job = jobs.get(id)
+
+    if job is None:
+        abort(404)
+
+    stream = request.args.get("stream", "stdout")
+
+    if stream not in STREAMS:
+        abort(400, message=f"Unknown stream {stream}")
+
+    output, offset = job.read_output(request.args.get("offset", 0, type=int), stream)
+
+    return {"output": output, "offset": offset, "status": job.status.value}
+
+
+@app.route("/job/<id>/events", methods=["GET"])
+def job_events(id: str):
+    """
+    Stream the stdout and stderr of a job as server-sent events until it is finished.
+    The last event contains the result.
+    """
+
+    job = jobs.get(id)
+
+    if job is None:
+        abort(404)
+
+    def events():
+        offsets = {stream: 0 for stream in STREAMS}
+
+        while True:
+            # Output written before the job finished is always sent
+            finished = job.status in FINISHED
+
+            for stream in STREAMS:
+                while True:
+                    output, offsets[stream] = job.read_output(offsets[stream], stream)
+                    if not output:
+                        break
+
+                    yield f"event: {stream}\ndata: {json.dumps(output)}\n\n"
+
+            if finished:
+                yield f"event: result\ndata: {json.dumps(job.info())}\n\n"
+                return
+
+            time.sleep(EVENT_INTERVAL)
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@app.route("/session", methods=["GET"])
+def list_sessions():
+    """
+    List running sessions
+    """
+
+    return {"sessions": code_exec.sessions.list()}
+
+
+@app.route("/session/<id>", methods=["DELETE"])
+def reset_session(id: str):
+    """
+    Reset a session (all variables are lost)
+    """
+
+    return {"id": id, "deleted": code_exec.sessions.reset(id)}
 
 
 @app.route("/image", methods=["GET", "DELETE"])
 def list_images():
     """
-    List existing images (and delete them)
+    List existing images, newest first (and delete them)
     """
 
-    image_list = [
-        os.path.basename(image) for image in iglob(os.path.join(IMAGE_PATH, "*.png"))
-    ]
+    image_list, total = page(code_exec.image_index)
     deleted = False
 
     if request.method == "DELETE":
@@ -58,11 +269,13 @@ def list_images():
 
         shutil.rmtree(IMAGE_PATH)
         os.mkdir(IMAGE_PATH)
+        code_exec.image_index.clear()
 
         deleted = True
 
     return {
         "images": image_list,
+        "total": total,
         "deleted": deleted,
     }
 
@@ -73,19 +286,17 @@ def serve_image(id: str):
     Serve image file based on the given id
     """
 
-    return send_file(os.path.join(IMAGE_PATH, f"{id}"), mimetype="image/png")
+    return send_file(os.path.join(IMAGE_PATH, f"{id}"))
 
 
 @app.route("/code", methods=["GET", "DELETE"])
 def list_codes():
     """
-    List existing Python files (and delete them)
+    List existing Python files, newest first (and delete them)
     """
 
-    code_list = [
-        os.path.basename(code).rstrip(".py")
-        for code in iglob(os.path.join(CODE_PATH, "*.py"))
-    ]
+    code_files, total = page(code_exec.code_index)
+    code_list = [os.path.splitext(code)[0] for code in code_files]
     deleted = False
 
     if request.method == "DELETE":
@@ -93,11 +304,13 @@ def list_codes():
 
         shutil.rmtree(CODE_PATH)
         os.mkdir(CODE_PATH)
+        code_exec.code_index.clear()
 
         deleted = True
 
     return {
         "codes": code_list,
+        "total": total,
         "deleted": deleted,
     }
 
@@ -114,10 +327,10 @@ def serve_code(id: str):
 @app.route("/data", methods=["GET", "DELETE"])
 def list_data():
     """
-    List existing Python files (and delete them)
+    List existing data files, newest first (and delete them)
     """
 
-    data_list = [os.path.basename(data) for data in iglob(os.path.join(DATA_PATH, "*"))]
+    data_list, total = page(code_exec.data_index)
     deleted = False
 
     if request.method == "DELETE":
@@ -125,10 +338,48 @@ def list_data():
 
         shutil.rmtree(DATA_PATH)
         os.mkdir(DATA_PATH)
+        code_exec.data_index.clear()
 
         deleted = True
 
-    return {"data": data_list, "deleted": deleted}
+    return {"data": data_list, "total": total, "deleted": deleted}
+
+
+@app.route("/data/<id>", methods=["PUT"])
+def upload_data(id: str):
+    """
+    Upload a data file. The body is streamed to disk, unchanged files aren't replaced.
+    The expected SHA-256 of the content can be sent in the X-Content-SHA256 header.
+    """
+
+    try:
+        info = data_store.put(
+            id, request.stream, request.headers.get("X-Content-SHA256")
+        )
+    except ValueError as err:
+        abort(400, message=str(err))
+
+    logging.info(f"Stored data {info['name']} (changed: {info['changed']})")
+    code_exec.data_index.add(info["name"])
+
+    return info, 201 if info["changed"] else 200
+
+
+@app.route("/data/<id>/info", methods=["GET"])
+def data_info(id: str):
+    """
+    Return size and SHA-256 of a data file
+    """
+
+    try:
+        info = data_store.info(id)
+    except ValueError:
+        abort(400)
+
+    if info is None:
+        abort(404)
+
+    return info
 
 
 @app.route("/data/<id>", methods=["GET"])
@@ -143,4 +394,8 @@ def serve_data(id: str):
 if __name__ == "__main__":
     from waitress import serve
 
+    # Warm up the workers before the first request arrives
+    code_exec.start_pool()
+    sweeper.start()
+
     serve(app, host="0.0.0.0", port=80)
@@ -0,0 +1,289 @@
+import io
+import os
+import time
+import types
+import resource
+import threading
+import traceback
+import multiprocessing as mp
+from uuid import uuid4
+from contextlib import redirect_stdout, redirect_stderr
+from multiprocessing.connection import Connection
+
+from worker_pool import (
+    WorkerResult,
+    OutputBuffer,
+    PRELOAD,
+    preload_modules,
+    script_globals,
+)
+
+
+class _TextSink(io.TextIOBase):
+    """Text stream on top of an `OutputBuffer`"""
+
+    def __init__(self, buffer: OutputBuffer):
+        self.buffer = buffer
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        self.buffer.write(text.encode("utf-8", errors="replace"))
+        return len(text)
+
+
+def _variables(namespace: dict, hidden: set[str], limit: int = 50) -> dict[str, str]:
+    """Names defined by the scripts of a session with their type (and shape)"""
+
+    variables = {}
+
+    for name, value in namespace.items():
+        if name.startswith("_") or name in hidden or isinstance(value, types.ModuleType):
+            continue
+
+        description = type(value).__name__
+
+        try:
+            shape = getattr(value, "shape", None)
+        except Exception:
+            shape = None
+
+        if isinstance(shape, tuple):
+            description += f" {shape}"
+
+        variables[name] = description
+
+        if len(variables) >= limit:
+            break
+
+    return variables
+
+
+def _session_main(conn: Connection, preload: list[str], memory_limit: int | None):
+    """Main loop of a session process. All scripts share one namespace"""
+
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    preload_modules(preload)
+
+    namespace = {"__name__": "__main__", **script_globals()}
+    hidden = set(namespace)
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+
+        if request is None:
+            break
+
+        file_path, cwd, max_output, output_path = request
+        buffers = [
+            OutputBuffer(max_output, output_path and f"{output_path}.{name}")
+            for name in ["stdout", "stderr"]
+        ]
+        stdout, stderr = [_TextSink(buffer) for buffer in buffers]
+        returncode = 0
+
+        try:
+            os.chdir(cwd)
+
+            with open(file_path) as f:
+                code = compile(f.read(), file_path, "exec")
+
+            namespace["__file__"] = file_path
+
+            with redirect_stdout(stdout), redirect_stderr(stderr):
+                exec(code, namespace)
+        except SystemExit as err:
+            returncode = err.code if isinstance(err.code, int) else 0
+        except MemoryError:
+            stderr.write("MemoryError: session memory limit reached\n")
+            returncode = 1
+        except BaseException as err:
+            # Hide the frame of the session loop
+            stderr.write(
+                "".join(
+                    traceback.format_exception(
+                        type(err), err, err.__traceback__.tb_next
+                    )
+                )
+            )
+            returncode = 1
+
+        for buffer in buffers:
+            buffer.close()
+
+        conn.send(
+            WorkerResult(
+                returncode,
+                buffers[0].getvalue(),
+                buffers[1].getvalue(),
+                truncated=buffers[0].truncated or buffers[1].truncated,
+                variables=_variables(namespace, hidden),
+            )
+        )
+
+
+class Session:
+    """Long-lived interpreter whose variables persist between scripts"""
+
+    def __init__(self, id: str, preload: list[str], memory_limit: int = None):
+        ctx = mp.get_context("spawn")
+
+        self.id = id
+        # A session which is reset or recreated gets a new instance (empty namespace)
+        self.instance = uuid4().hex
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_session_main, args=(child_conn, preload, memory_limit), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+
+        self.created = time.time()
+        self.last_used = time.time()
+        self.runs = 0
+        self.variables: dict[str, str] = {}
+        self.lock = threading.Lock()
+
+    def run(
+        self,
+        file_path: str,
+        cwd: str,
+        timeout: float = None,
+        max_output: int = None,
+        output_path: str = None,
+    ) -> WorkerResult:
+        with self.lock:
+            self.runs += 1
+            self.conn.send((file_path, cwd, max_output, output_path))
+
+            if not self.conn.poll(timeout):
+                # A stuck script can't be interrupted, the session is lost
+                self.close()
+                return WorkerResult(-9, b"", b"Session timed out and was reset\n", True)
+
+            try:
+                result = self.conn.recv()
+            except EOFError:
+                result = WorkerResult(
+                    self.process.exitcode or 1, b"", b"Session crashed and was reset\n"
+                )
+
+            # Nothing is left of a session which timed out or crashed
+            self.variables = result.variables or {}
+            self.last_used = time.time()
+            return result
+
+    def is_alive(self) -> bool:
+        return self.process.is_alive()
+
+    def info(self) -> dict:
+        return {
+            "id": self.id,
+            "created": self.created,
+            "last_used": self.last_used,
+            "runs": self.runs,
+            "variables": self.variables,
+        }
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+
+        self.process.join(timeout=1)
+
+        if self.process.is_alive():
+            self.process.kill()
+
+
+class SessionManager:
+    """Maps session IDs to long-lived interpreters
+
+    Sessions are closed after `idle_timeout` seconds without a run. If `max_sessions`
+    is reached, the least recently used session is closed.
+    """
+
+    def __init__(
+        self,
+        idle_timeout: float = 1800,
+        max_sessions: int = 8,
+        memory_limit_mb: int = None,
+        preload: list[str] = PRELOAD,
+    ):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.memory_limit = memory_limit_mb * 1024 * 1024 if memory_limit_mb else None
+        self.preload = preload
+
+        self._sessions: dict[str, Session] = {}
+        self._lock = threading.Lock()
+
+        threading.Thread(target=self._sweep, daemon=True).start()
+
+    def get(self, id: str) -> Session:
+        """Return the session with the given ID, create it if necessary"""
+
+        with self._lock:
+            session = self._sessions.get(id)
+
+            if session is not None and session.is_alive():
+                return session
+
+            if len(self._sessions) >= self.max_sessions:
+                lru = min(self._sessions.values(), key=lambda s: s.last_used)
+                self._sessions.pop(lru.id).close()
+
+            session = Session(id, self.preload, self.memory_limit)
+            self._sessions[id] = session
+
+            return session
+
+    def run(
+        self,
+        id: str,
+        file_path: str,
+        cwd: str,
+        timeout: float = None,
+        max_output: int = None,
+        output_path: str = None,
+    ) -> WorkerResult:
+        return self.get(id).run(file_path, cwd, timeout, max_output, output_path)
+
+    def reset(self, id: str) -> bool:
+        """Close a session, the next run starts with an empty namespace"""
+
+        with self._lock:
+            session = self._sessions.pop(id, None)
+
+        if session is None:
+            return False
+
+        session.close()
+        return True
+
+    def list(self) -> list[dict]:
+        with self._lock:
+            return [session.info() for session in self._sessions.values()]
+
+    def _sweep(self):
+        while True:
+            time.sleep(min(60, self.idle_timeout))
+
+            now = time.time()
+            with self._lock:
+                idle = [
+                    id
+                    for id, session in self._sessions.items()
+                    if now - session.last_used > self.idle_timeout
+                    and not session.lock.locked()
+                ]
+
+            for id in idle:
+                self.reset(id)
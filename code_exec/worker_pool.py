@@ -0,0 +1,399 @@
+import os
+import sys
+import queue
+import time
+import signal
+import runpy
+import resource
+import threading
+import traceback
+import multiprocessing as mp
+from multiprocessing.connection import Connection
+from typing import BinaryIO, Callable
+
+
+PRELOAD = [
+    "numpy",
+    "pandas",
+    "pyarrow",
+    "matplotlib",
+    "matplotlib.pyplot",
+    "data_loader",
+    "display_hooks",
+]
+
+
+class WorkerResult:
+    """Output of a script executed by a worker"""
+
+    def __init__(
+        self,
+        returncode: int,
+        stdout: bytes,
+        stderr: bytes,
+        timed_out: bool = False,
+        truncated: bool = False,
+        variables: dict[str, str] = None,
+    ):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        self.truncated = truncated
+        # Names defined in the namespace of a session with their type
+        self.variables = variables
+
+
+class OutputBuffer:
+    """Collects the output of a script up to `max_bytes` and copies it to `path` if given
+
+    Output after the limit is dropped, except for the last `tail_bytes` (part of the
+    limit) which are kept in memory, so a traceback at the end isn't lost.
+    """
+
+    def __init__(self, max_bytes: int = None, path: str = None, tail_bytes: int = 8192):
+        self.max_bytes = max_bytes
+        self.tail_bytes = 0 if max_bytes is None else min(tail_bytes, max_bytes // 4)
+        self.size = 0
+
+        self._head = bytearray()
+        self._tail = bytearray()
+        self._file = open(path, "wb") if path is not None else None
+
+    @property
+    def truncated(self) -> bool:
+        return self.max_bytes is not None and self.size > self.max_bytes
+
+    def write(self, chunk: bytes):
+        if self.max_bytes is None:
+            head, rest, streamed = chunk, b"", chunk
+        else:
+            room = max(0, self.max_bytes - self.tail_bytes - len(self._head))
+            head, rest = chunk[:room], chunk[room:]
+            streamed = chunk[: max(0, self.max_bytes - self.size)]
+
+        was_truncated = self.truncated
+        self.size += len(chunk)
+        self._head += head
+
+        if rest:
+            self._tail += rest
+            del self._tail[: -self.tail_bytes or len(self._tail)]
+
+        if self._file is not None:
+            self._file.write(streamed)
+
+            if self.truncated and not was_truncated:
+                self._file.write(b"\n... [output truncated] ...\n")
+
+            self._file.flush()
+
+    def getvalue(self) -> bytes:
+        if not self.truncated:
+            return bytes(self._head + self._tail)
+
+        dropped = self.size - len(self._head) - len(self._tail)
+        return (
+            bytes(self._head)
+            + f"\n... [{dropped} bytes truncated] ...\n".encode("utf-8")
+            + bytes(self._tail)
+        )
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def _drain(f: BinaryIO, buffer: OutputBuffer):
+    """Read a pipe until it is closed (output beyond the limit is discarded)"""
+
+    with f:
+        while chunk := f.read1(65536):
+            buffer.write(chunk)
+
+
+def collect_output(
+    stdout: BinaryIO,
+    stderr: BinaryIO,
+    timeout: float | None,
+    kill: Callable[[], None],
+    max_output: int = None,
+    output_path: str = None,
+) -> tuple[OutputBuffer, OutputBuffer, bool]:
+    """Read stdout and stderr of a process until it exits or the timeout is reached
+
+    If `output_path` is given, the output is copied to `<output_path>.stdout` and
+    `<output_path>.stderr` while the process runs.
+
+    RETURNS
+        stdout (OutputBuffer): Collected stdout
+        stderr (OutputBuffer): Collected stderr
+        timed_out (bool): The process was killed because it reached the timeout
+    """
+
+    buffers = [
+        OutputBuffer(max_output, output_path and f"{output_path}.{name}")
+        for name in ["stdout", "stderr"]
+    ]
+    readers = [
+        threading.Thread(target=_drain, args=(f, buffer), daemon=True)
+        for f, buffer in zip([stdout, stderr], buffers)
+    ]
+
+    for reader in readers:
+        reader.start()
+
+    # The pipes are closed as soon as the process exits
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for reader in readers:
+        reader.join(None if deadline is None else max(0, deadline - time.monotonic()))
+
+    timed_out = any(reader.is_alive() for reader in readers)
+
+    if timed_out:
+        kill()
+
+    for reader in readers:
+        reader.join()
+    for buffer in buffers:
+        buffer.close()
+
+    return (buffers[0], buffers[1], timed_out)
+
+
+def _exec_child(file_path: str, cwd: str, cpu_limit: int | None):
+    """Execute a script inside the forked child (never returns)"""
+
+    code = 0
+
+    try:
+        if cpu_limit:
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 1))
+
+        os.chdir(cwd)
+        sys.argv = [file_path]
+        runpy.run_path(file_path, init_globals=script_globals(), run_name="__main__")
+    except SystemExit as err:
+        code = err.code if isinstance(err.code, int) else (0 if err.code is None else 1)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def _run_forked(
+    file_path: str,
+    cwd: str,
+    timeout: float | None,
+    cpu_limit: int = None,
+    max_output: int = None,
+    output_path: str = None,
+    on_start: Callable[[int], None] = None,
+) -> WorkerResult:
+    """Fork the warm template process and run the script in the child"""
+
+    out_r, out_w = os.pipe()
+    err_r, err_w = os.pipe()
+
+    pid = os.fork()
+
+    if pid == 0:
+        os.close(out_r)
+        os.close(err_r)
+        os.dup2(out_w, 1)
+        os.dup2(err_w, 2)
+        os.close(out_w)
+        os.close(err_w)
+
+        # Python level streams need to be recreated on top of the new file descriptors
+        sys.stdout = os.fdopen(1, "w", buffering=1)
+        sys.stderr = os.fdopen(2, "w", buffering=1)
+
+        _exec_child(file_path, cwd, cpu_limit)
+
+    if on_start is not None:
+        on_start(pid)
+
+    os.close(out_w)
+    os.close(err_w)
+
+    stdout, stderr, timed_out = collect_output(
+        os.fdopen(out_r, "rb"),
+        os.fdopen(err_r, "rb"),
+        timeout,
+        lambda: os.kill(pid, signal.SIGKILL),
+        max_output,
+        output_path,
+    )
+
+    _, status = os.waitpid(pid, 0)
+
+    return WorkerResult(
+        os.waitstatus_to_exitcode(status),
+        stdout.getvalue(),
+        stderr.getvalue(),
+        timed_out,
+        stdout.truncated or stderr.truncated,
+    )
+
+
+def script_globals() -> dict:
+    """Helpers which every script can use without importing them"""
+
+    import display_hooks
+
+    helpers = {"__show__": display_hooks.show, "__display__": display_hooks.display}
+
+    try:
+        from data_loader import load_data, load_table
+    except ImportError:
+        return helpers
+
+    return {**helpers, "load_data": load_data, "load_table": load_table}
+
+
+def preload_modules(modules: list[str]):
+    """Import modules ahead of the first script"""
+
+    os.environ.setdefault("MPLBACKEND", "Agg")
+
+    for module in modules:
+        try:
+            __import__(module)
+        except ImportError as err:
+            print(f"Failed to preload {module}: {err}", file=sys.stderr)
+
+
+def _template_main(conn: Connection, preload: list[str]):
+    """Main loop of a warm template process"""
+
+    preload_modules(preload)
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+
+        if request is None:
+            break
+
+        conn.send(_run_forked(*request, on_start=conn.send))
+
+
+class Worker:
+    """Warm template process which forks a clean child for every script"""
+
+    def __init__(self, preload: list[str]):
+        ctx = mp.get_context("spawn")
+
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_template_main, args=(child_conn, preload), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+
+        self.runs = 0
+
+    def run(
+        self,
+        file_path: str,
+        cwd: str,
+        timeout: float = None,
+        cpu_limit: int = None,
+        max_output: int = None,
+        output_path: str = None,
+        on_start: Callable[[int], None] = None,
+    ) -> WorkerResult:
+        self.runs += 1
+
+        self.conn.send((file_path, cwd, timeout, cpu_limit, max_output, output_path))
+
+        # The template reports the PID of the child first, so it can be killed
+        pid = self.conn.recv()
+        if on_start is not None:
+            on_start(pid)
+
+        return self.conn.recv()
+
+    def is_alive(self) -> bool:
+        return self.process.is_alive()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+
+        self.process.join(timeout=5)
+
+        if self.process.is_alive():
+            self.process.kill()
+
+
+class WorkerPool:
+    """Pool of warm template processes with the common data science packages imported
+
+    Every script runs in a fresh fork of a template, so scripts can't affect each other,
+    but don't pay for interpreter startup and imports.
+    Templates are replaced after `recycle_after` runs.
+    """
+
+    def __init__(
+        self,
+        size: int = 2,
+        recycle_after: int = 100,
+        preload: list[str] = PRELOAD,
+    ):
+        self.size = size
+        self.recycle_after = recycle_after
+        self.preload = preload
+
+        self._idle: queue.Queue[Worker] = queue.Queue()
+        for _ in range(size):
+            self._idle.put(Worker(preload))
+
+    def run(
+        self,
+        file_path: str,
+        cwd: str,
+        timeout: float = None,
+        cpu_limit: int = None,
+        max_output: int = None,
+        output_path: str = None,
+        on_start: Callable[[int], None] = None,
+    ) -> WorkerResult:
+        """Run a python script in one of the workers (blocks until a worker is idle)
+
+        ARGUMENTS
+            timeout (float): Wall-clock limit in seconds
+            cpu_limit (int): CPU time limit in seconds
+            max_output (int): Number of bytes of stdout and stderr which are kept
+            output_path (str): Prefix of the files which receive the output while the script runs
+            on_start (Callable[[int], None]): Called with the PID of the script process
+        """
+
+        worker = self._idle.get()
+
+        try:
+            return worker.run(
+                file_path, cwd, timeout, cpu_limit, max_output, output_path, on_start
+            )
+        except (EOFError, BrokenPipeError, OSError):
+            worker.close()
+            worker = Worker(self.preload)
+            raise
+        finally:
+            if worker.runs >= self.recycle_after or not worker.is_alive():
+                worker.close()
+                worker = Worker(self.preload)
+
+            self._idle.put(worker)
+
+    def close(self):
+        for _ in range(self.size):
+            self._idle.get().close()
@@ -17,6 +17,9 @@ def update_template(name: str, agent: str, key: str, value: str):
 
     setattr(shared.templates[agent][name], key, value)
 
+    # Recompile the parser of the edited template right away
+    shared.templates[agent][name].build_parser()
+
 
 def create_template(
     name: str, agent: str, template: ToolChainTemplate | SummaryTemplate | ObjectiveTemplate
@@ -24,6 +27,7 @@ def create_template(
     """Create new template"""
 
     shared.templates[agent][name] = template
+    template.build_parser()
 
 
 def load_templates() -> dict[str, dict[ToolChainTemplate | SummaryTemplate | ObjectiveTemplate]]:
@@ -32,7 +36,7 @@ def load_templates() -> dict[str, dict[ToolChainTemplate | SummaryTemplate | Obj
     with open(os.path.join(_BASE_PATH, "templates.json")) as f:
         template_dict: dict[str, dict] = json.load(f)
 
-    return {
+    templates = {
         "ToolChainAgent": {
             key: ToolChainTemplate(**vals)
             for key, vals in template_dict["ToolChainAgent"].items()
@@ -51,6 +55,12 @@ def load_templates() -> dict[str, dict[ToolChainTemplate | SummaryTemplate | Obj
         }
     }
 
+    for agent_templates in templates.values():
+        for template in agent_templates.values():
+            template.build_parser()
+
+    return templates
+
 
 def save_templates(
     templates: dict[str, dict[str, ToolChainTemplate | SummaryTemplate | ObjectiveTemplate]]
@@ -58,7 +68,7 @@ def save_templates(
     """Save templates to templates.json"""
 
     template_dict = {
-        key: {name: val.__dict__ for name, val in template.items()}
+        key: {name: val.to_dict() for name, val in template.items()}
         for key, template in templates.items()
     }
 
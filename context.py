@@ -0,0 +1,202 @@
+import re
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from typing import Awaitable, Callable
+
+import requests as req
+
+
+class Tokenizer(ABC):
+    """Counts the tokens of a text"""
+
+    @abstractmethod
+    def count(self, text: str) -> int:
+        raise NotImplementedError("Every tokenizer needs to implement the `count` method")
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Return the longest prefix of the text with at most `max_tokens` tokens"""
+
+        if max_tokens <= 0:
+            return ""
+
+        if self.count(text) <= max_tokens:
+            return text
+
+        # Binary search for the longest prefix which fits
+        low, high = 0, len(text)
+        while low < high:
+            mid = (low + high + 1) // 2
+
+            if self.count(text[:mid]) <= max_tokens:
+                low = mid
+            else:
+                high = mid - 1
+
+        return text[:low]
+
+
+class RegexTokenizer(Tokenizer):
+    """Local approximation of a LLM tokenizer
+
+    Every word is counted as one token per `chars_per_token` characters and every other
+    non whitespace character as one token.
+    """
+
+    _PATTERN = re.compile(r"\w+|[^\w\s]")
+
+    def __init__(self, chars_per_token: int = 4):
+        self.chars_per_token = chars_per_token
+
+    def _token_len(self, match: re.Match) -> int:
+        return -(-(match.end() - match.start()) // self.chars_per_token)
+
+    def count(self, text: str) -> int:
+        return sum(self._token_len(match) for match in self._PATTERN.finditer(text))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        if max_tokens <= 0:
+            return ""
+
+        tokens = 0
+        for match in self._PATTERN.finditer(text):
+            tokens += self._token_len(match)
+
+            if tokens > max_tokens:
+                return text[: match.start()].rstrip()
+
+        return text
+
+
+class OobaboogaTokenizer(Tokenizer):
+    """Counts tokens with the tokenizer of the model loaded in the webui"""
+
+    def __init__(self, api_endpoint: str, session: req.Session = None, timeout=None):
+        self.api_endpoint = api_endpoint
+        self.session = session or req.Session()
+        self.timeout = timeout
+
+    def count(self, text: str) -> int:
+        res = self.session.post(
+            f"{self.api_endpoint}/api/v1/token-count",
+            json={"prompt": text},
+            timeout=self.timeout,
+        )
+
+        if res.status_code != 200:
+            raise ValueError(f"Token count failed with code {res.status_code}")
+
+        return res.json()["results"][0]["tokens"]
+
+
+class ContextBudget:
+    """Keeps the prompt of an action chain within the context size of the model
+
+    Room for `reserve_tokens` new tokens is kept free. If the prompt is too long, the
+    observations of the oldest steps are summarized first and truncated if that isn't enough.
+    """
+
+    TRUNCATION_MARKER = " ..."
+
+    def __init__(
+        self,
+        tokenizer: Tokenizer,
+        max_context_tokens: int = 2048,
+        reserve_tokens: int = 200,
+        cache_size: int = 256,
+    ):
+        self.tokenizer = tokenizer
+        self.max_context_tokens = max_context_tokens
+        self.reserve_tokens = reserve_tokens
+
+        # Prompt parts are counted again on every step
+        self.count = lru_cache(maxsize=cache_size)(tokenizer.count)
+
+    @property
+    def budget(self) -> int:
+        """Maximum number of tokens in the prompt"""
+
+        return self.max_context_tokens - self.reserve_tokens
+
+    def count_prompt(self, prompt) -> int:
+        """Count the tokens of a `ToolChainPrompt`"""
+
+        return (
+            self.count(prompt.prefix)
+            + sum(self.count(block) for block in prompt.blocks)
+            + self.count(prompt.tail)
+        )
+
+    def fit(self, prompt, summarize: Callable[[str], str] = None) -> int:
+        """Shrink the observations of a `ToolChainPrompt` until it fits into the budget
+
+        RETURNS
+            tokens (int): Number of tokens in the prompt after shrinking
+        """
+
+        total = self.count_prompt(prompt)
+
+        if summarize is not None:
+            for i in self._summary_candidates(prompt):
+                if total <= self.budget:
+                    break
+
+                total = self._replace(
+                    prompt, i, summarize(prompt.steps[i].observation), total
+                )
+                prompt.summarized.add(i)
+
+        return self._truncate(prompt, total)
+
+    async def afit(
+        self, prompt, summarize: Callable[[str], Awaitable[str]] = None
+    ) -> int:
+        """Shrink the observations of a `ToolChainPrompt` without blocking the event loop"""
+
+        total = self.count_prompt(prompt)
+
+        if summarize is not None:
+            for i in self._summary_candidates(prompt):
+                if total <= self.budget:
+                    break
+
+                total = self._replace(
+                    prompt, i, await summarize(prompt.steps[i].observation), total
+                )
+                prompt.summarized.add(i)
+
+        return self._truncate(prompt, total)
+
+    def _summary_candidates(self, prompt) -> list[int]:
+        return [i for i in range(len(prompt.steps)) if i not in prompt.summarized]
+
+    def _replace(self, prompt, i: int, observation: str, total: int) -> int:
+        """Replace the observation of a step and return the new token count"""
+
+        total -= self.count(prompt.blocks[i])
+        prompt.set_observation(i, observation)
+
+        return total + self.count(prompt.blocks[i])
+
+    def _truncate(self, prompt, total: int) -> int:
+        for i, step in enumerate(prompt.steps):
+            excess = total - self.budget
+            if excess <= 0:
+                break
+
+            observation_tokens = self.count(step.observation)
+            if observation_tokens == 0:
+                continue
+
+            # Truncated again in a later step, the previous marker is replaced
+            observation = self.tokenizer.truncate(
+                step.observation.removesuffix(self.TRUNCATION_MARKER),
+                observation_tokens - excess - self.count(self.TRUNCATION_MARKER),
+            )
+            total = self._replace(prompt, i, observation + self.TRUNCATION_MARKER, total)
+
+        if total > self.budget:
+            print(
+                f"> Prompt exceeds the context budget ({total} > {self.budget} tokens)"
+            )
+
+        return total
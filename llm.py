@@ -1,6 +1,17 @@
+import re
+import json
+import asyncio
+import hashlib
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
 
+import aiohttp
 import requests as req
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from extensions.auto_llama.cache import CacheEntry, TieredCache
 
 
 class LLMInterface(ABC):
@@ -11,10 +22,12 @@ class LLMInterface(ABC):
         stopping_strings: list[str] = [],
         temperature: float = 0.5,
         max_new_tokens: int = 200,
+        max_concurrency: int = 4,
     ):
         self.stopping_strings = stopping_strings
         self.temperature = temperature
         self.max_new_tokens = max_new_tokens
+        self.max_concurrency = max_concurrency
 
     def completion(
         self,
@@ -32,6 +45,182 @@ class LLMInterface(ABC):
             max_new_tokens=max_new_tokens or self.max_new_tokens,
         )
 
+    async def acompletion(
+        self,
+        prompt: str,
+        stopping_strings: list[str] = [],
+        temperature: float = None,
+        max_new_tokens: int = None,
+    ) -> str:
+        """Run LLM Text completion without blocking the event loop"""
+
+        return await self._acompletion(
+            prompt,
+            stopping_strings=[*self.stopping_strings, *stopping_strings],
+            temperature=temperature or self.temperature,
+            max_new_tokens=max_new_tokens or self.max_new_tokens,
+        )
+
+    def batch_completion(
+        self,
+        prompts: list[str],
+        stopping_strings: list[str] = [],
+        temperature: float = None,
+        max_new_tokens: int = None,
+    ) -> list[str]:
+        """Run LLM Text completion for multiple prompts at once
+
+        Results are returned in the order of the prompts.
+        """
+
+        if not prompts:
+            return []
+
+        return self._batch_completion(
+            prompts,
+            stopping_strings=[*self.stopping_strings, *stopping_strings],
+            temperature=temperature or self.temperature,
+            max_new_tokens=max_new_tokens or self.max_new_tokens,
+        )
+
+    async def abatch_completion(
+        self,
+        prompts: list[str],
+        stopping_strings: list[str] = [],
+        temperature: float = None,
+        max_new_tokens: int = None,
+    ) -> list[str]:
+        """Run LLM Text completion for multiple prompts without blocking the event loop"""
+
+        if not prompts:
+            return []
+
+        # Backends with native batching get all prompts at once
+        if type(self)._batch_completion is not LLMInterface._batch_completion:
+            return await asyncio.to_thread(
+                self.batch_completion,
+                prompts,
+                stopping_strings=stopping_strings,
+                temperature=temperature,
+                max_new_tokens=max_new_tokens,
+            )
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def bounded_completion(prompt: str) -> str:
+            async with semaphore:
+                return await self.acompletion(
+                    prompt,
+                    stopping_strings=stopping_strings,
+                    temperature=temperature,
+                    max_new_tokens=max_new_tokens,
+                )
+
+        return await asyncio.gather(*(bounded_completion(p) for p in prompts))
+
+    def stream(
+        self,
+        prompt: str,
+        stopping_strings: list[str] = [],
+        stop_patterns: list[re.Pattern] = [],
+        temperature: float = None,
+        max_new_tokens: int = None,
+    ) -> Iterator[str]:
+        """Run LLM Text completion and yield the generated text chunk by chunk
+
+        Stopping strings are also checked on the client side. The generated text is cut
+        before a stopping string and after a match of one of the `stop_patterns`.
+        Patterns are matched against complete lines, so they should not span multiple lines.
+        Generation is cancelled as soon as a stop is detected.
+        """
+
+        stopping_strings = [*self.stopping_strings, *stopping_strings]
+        max_stop_len = max((len(stop) for stop in stopping_strings), default=0)
+
+        chunks = self._stream(
+            prompt,
+            stopping_strings=stopping_strings,
+            temperature=temperature or self.temperature,
+            max_new_tokens=max_new_tokens or self.max_new_tokens,
+        )
+
+        text = ""
+        emitted = 0
+
+        try:
+            for chunk in chunks:
+                start = len(text)
+                text += chunk
+
+                stop = self._find_stop(
+                    text,
+                    stopping_strings,
+                    stop_patterns,
+                    max(0, start - max_stop_len),
+                    text.rfind("\n", 0, start) + 1,
+                )
+
+                if stop is not None:
+                    if stop > emitted:
+                        yield text[emitted:stop]
+                    return
+
+                # Hold back text which could be the beginning of a stopping string
+                safe = max(emitted, len(text) - max_stop_len)
+                if safe > emitted:
+                    yield text[emitted:safe]
+                    emitted = safe
+
+            if len(text) > emitted:
+                yield text[emitted:]
+        finally:
+            chunks.close()
+
+    def stream_completion(
+        self,
+        prompt: str,
+        stopping_strings: list[str] = [],
+        stop_patterns: list[re.Pattern] = [],
+        temperature: float = None,
+        max_new_tokens: int = None,
+    ) -> str:
+        """Run streaming LLM Text completion and return the text once a stop is reached"""
+
+        return "".join(
+            self.stream(
+                prompt,
+                stopping_strings=stopping_strings,
+                stop_patterns=stop_patterns,
+                temperature=temperature,
+                max_new_tokens=max_new_tokens,
+            )
+        )
+
+    @staticmethod
+    def _find_stop(
+        text: str,
+        stopping_strings: list[str],
+        stop_patterns: list[re.Pattern],
+        string_start: int,
+        line_start: int,
+    ) -> int | None:
+        """Return the index at which the text should be cut or None"""
+
+        stops = []
+
+        for stop in stopping_strings:
+            idx = text.find(stop, string_start)
+            if idx >= 0:
+                stops.append(idx)
+
+        # Patterns only need to be checked against the lines which changed
+        for pattern in stop_patterns:
+            match = pattern.search(text, line_start)
+            if match:
+                stops.append(match.end())
+
+        return min(stops, default=None)
+
     @abstractmethod
     def _completion(
         self,
@@ -44,6 +233,61 @@ class LLMInterface(ABC):
             "The `completion` method needs to be implemented by each LLM Interface"
         )
 
+    def _batch_completion(
+        self,
+        prompts: list[str],
+        stopping_strings: list[str],
+        temperature: float,
+        max_new_tokens: int,
+    ) -> list[str]:
+        """Run completion for multiple prompts. Falls back to concurrent single completions
+
+        LLM Interfaces with a backend which supports batching should override this method.
+        """
+
+        if len(prompts) == 1:
+            return [
+                self._completion(
+                    prompts[0], stopping_strings, temperature, max_new_tokens
+                )
+            ]
+
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_concurrency, len(prompts))
+        ) as pool:
+            return list(
+                pool.map(
+                    lambda prompt: self._completion(
+                        prompt, stopping_strings, temperature, max_new_tokens
+                    ),
+                    prompts,
+                )
+            )
+
+    async def _acompletion(
+        self,
+        prompt: str,
+        stopping_strings: list[str],
+        temperature: float,
+        max_new_tokens: int,
+    ) -> str:
+        """Run completion asynchronously. Falls back to running `_completion` in a worker thread"""
+
+        return await asyncio.to_thread(
+            self._completion, prompt, stopping_strings, temperature, max_new_tokens
+        )
+
+    def _stream(
+        self,
+        prompt: str,
+        stopping_strings: list[str],
+        temperature: float,
+        max_new_tokens: int,
+    ) -> Iterator[str]:
+        """Yield generated text chunks. Falls back to a single chunk if the LLM can't stream"""
+
+        yield self._completion(prompt, stopping_strings, temperature, max_new_tokens)
+
 
 class OobaboogaLLM(LLMInterface):
     """LLM Interface calling the oobabooga api for text generation"""
@@ -54,10 +298,108 @@ class OobaboogaLLM(LLMInterface):
         stopping_strings: list[str] = [],
         temperature: float = 0.5,
         max_new_tokens: int = 200,
+        pool_size: int = 4,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 300.0,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        stream_endpoint: str = None,
     ):
         self.api_endpoint = api_endpoint
+        self.stream_endpoint = stream_endpoint
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.session = self._create_session(pool_size, max_retries, backoff_factor)
+
+        self._async_session: aiohttp.ClientSession = None
+        self._async_loop: asyncio.AbstractEventLoop = None
+
+        # Never run more requests at once than there are pooled connections
+        super().__init__(
+            stopping_strings, temperature, max_new_tokens, max_concurrency=pool_size
+        )
+
+    @staticmethod
+    def _create_session(
+        pool_size: int, max_retries: int, backoff_factor: float
+    ) -> req.Session:
+        """Create a keep-alive session which retries failed connects and 502/503/504 errors
+
+        Generation requests are not idempotent, so they are never sent again once the
+        backend might have received them (read errors and timeouts).
+        """
+
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=0,
+            other=0,
+            status=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=None,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
 
-        super().__init__(stopping_strings, temperature, max_new_tokens)
+        session = req.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        return session
+
+    async def _get_async_session(self) -> aiohttp.ClientSession:
+        """Return the pooled async session bound to the running event loop"""
+
+        loop = asyncio.get_running_loop()
+
+        if self._async_session is not None and self._async_loop is not loop:
+            await self._close_stale_session()
+
+        if self._async_session is None or self._async_session.closed:
+            self._async_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=self.timeout[0], sock_read=self.timeout[1]
+                ),
+            )
+            self._async_loop = loop
+
+        return self._async_session
+
+    async def _close_stale_session(self):
+        """Close the async session of an event loop which is no longer used"""
+
+        session, loop = self._async_session, self._async_loop
+        self._async_session, self._async_loop = None, None
+
+        if session.closed:
+            return
+
+        if loop.is_running():
+            # Connections can only be closed on the loop they belong to
+            await asyncio.wrap_future(
+                asyncio.run_coroutine_threadsafe(session.close(), loop)
+            )
+        else:
+            # Transports of a closed loop are skipped, so only the session is closed
+            await session.close()
+
+    def close(self):
+        """Close all pooled connections"""
+
+        self.session.close()
+
+    async def aclose(self):
+        """Close all pooled connections of the async session"""
+
+        if self._async_session is not None:
+            await self._async_session.close()
+            self._async_session, self._async_loop = None, None
 
     def _completion(
         self,
@@ -65,7 +407,7 @@ class OobaboogaLLM(LLMInterface):
         stopping_strings: list[str],
         temperature: float,
         max_new_tokens: int,
-    ) -> str:        
+    ) -> str:
         url = f"{self.api_endpoint}/api/v1/generate"
         body = {
             "prompt": prompt,
@@ -74,7 +416,7 @@ class OobaboogaLLM(LLMInterface):
             "max_new_tokens": max_new_tokens,
         }
 
-        res = req.post(url, json=body)
+        res = self.session.post(url, json=body, timeout=self.timeout)
 
         if res.status_code != 200:
             raise ValueError(f"LLM Completion failed with code {res.status_code}")
@@ -83,3 +425,204 @@ class OobaboogaLLM(LLMInterface):
         text = res_dict["results"][0]["text"]
 
         return text
+
+    async def _acompletion(
+        self,
+        prompt: str,
+        stopping_strings: list[str],
+        temperature: float,
+        max_new_tokens: int,
+    ) -> str:
+        url = f"{self.api_endpoint}/api/v1/generate"
+        body = {
+            "prompt": prompt,
+            "stopping_strings": stopping_strings,
+            "temperature": temperature,
+            "max_new_tokens": max_new_tokens,
+        }
+
+        session = await self._get_async_session()
+
+        for attempt in range(self.max_retries + 1):
+            retry = attempt < self.max_retries
+
+            try:
+                async with session.post(url, json=body) as res:
+                    if res.status in (502, 503, 504) and retry:
+                        await asyncio.sleep(self.backoff_factor * 2**attempt)
+                        continue
+
+                    if res.status != 200:
+                        raise ValueError(
+                            f"LLM Completion failed with code {res.status}"
+                        )
+
+                    res_dict = await res.json()
+                    return res_dict["results"][0]["text"]
+            except aiohttp.ClientConnectorError:
+                # Like the sync session, only retry if the request was never sent
+                if not retry:
+                    raise
+
+                await asyncio.sleep(self.backoff_factor * 2**attempt)
+
+    def _stream(
+        self,
+        prompt: str,
+        stopping_strings: list[str],
+        temperature: float,
+        max_new_tokens: int,
+    ) -> Iterator[str]:
+        if not self.stream_endpoint:
+            yield from super()._stream(
+                prompt, stopping_strings, temperature, max_new_tokens
+            )
+            return
+
+        from websockets.sync.client import connect
+
+        url = f"{self.stream_endpoint}/api/v1/stream"
+        body = {
+            "prompt": prompt,
+            "stopping_strings": stopping_strings,
+            "temperature": temperature,
+            "max_new_tokens": max_new_tokens,
+        }
+
+        # Leaving the block closes the websocket, which only stops this generation
+        with connect(url, open_timeout=self.timeout[0]) as ws:
+            ws.send(json.dumps(body))
+
+            while True:
+                msg = json.loads(ws.recv(timeout=self.timeout[1]))
+
+                if msg["event"] == "text_stream":
+                    yield msg["text"]
+                elif msg["event"] == "stream_end":
+                    return
+
+
+class CachedLLM(LLMInterface):
+    """LLM Interface which caches the completions of another LLM Interface
+
+    Completions are cached by a hash of prompt, stopping strings, temperature and max_new_tokens.
+    """
+
+    def __init__(self, llm: LLMInterface, cache: TieredCache):
+        self.llm = llm
+        self.cache = cache
+
+        super().__init__(
+            llm.stopping_strings,
+            llm.temperature,
+            llm.max_new_tokens,
+            max_concurrency=llm.max_concurrency,
+        )
+
+    @property
+    def stats(self):
+        return self.cache.stats
+
+    @staticmethod
+    def _key(
+        prompt: str, stopping_strings: list[str], temperature: float, max_new_tokens: int
+    ) -> str:
+        data = json.dumps([prompt, stopping_strings, temperature, max_new_tokens])
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _lookup(self, key: str) -> str | None:
+        entry = self.cache.get(key)
+        return entry.value if entry is not None else None
+
+    def _completion(
+        self,
+        prompt: str,
+        stopping_strings: list[str],
+        temperature: float,
+        max_new_tokens: int,
+    ) -> str:
+        key = self._key(prompt, stopping_strings, temperature, max_new_tokens)
+        text = self._lookup(key)
+
+        if text is None:
+            text = self.llm._completion(
+                prompt, stopping_strings, temperature, max_new_tokens
+            )
+            self.cache.set(key, CacheEntry(text))
+
+        return text
+
+    async def _acompletion(
+        self,
+        prompt: str,
+        stopping_strings: list[str],
+        temperature: float,
+        max_new_tokens: int,
+    ) -> str:
+        key = self._key(prompt, stopping_strings, temperature, max_new_tokens)
+        text = self._lookup(key)
+
+        if text is None:
+            text = await self.llm._acompletion(
+                prompt, stopping_strings, temperature, max_new_tokens
+            )
+            self.cache.set(key, CacheEntry(text))
+
+        return text
+
+    def _batch_completion(
+        self,
+        prompts: list[str],
+        stopping_strings: list[str],
+        temperature: float,
+        max_new_tokens: int,
+    ) -> list[str]:
+        keys = [
+            self._key(prompt, stopping_strings, temperature, max_new_tokens)
+            for prompt in prompts
+        ]
+        texts = [self._lookup(key) for key in keys]
+
+        # Only send the prompts which are not cached yet
+        missing = [i for i, text in enumerate(texts) if text is None]
+
+        if missing:
+            results = self.llm._batch_completion(
+                [prompts[i] for i in missing],
+                stopping_strings,
+                temperature,
+                max_new_tokens,
+            )
+
+            for i, text in zip(missing, results):
+                texts[i] = text
+                self.cache.set(keys[i], CacheEntry(text))
+
+        return texts
+
+    def _stream(
+        self,
+        prompt: str,
+        stopping_strings: list[str],
+        temperature: float,
+        max_new_tokens: int,
+    ) -> Iterator[str]:
+        key = self._key(prompt, stopping_strings, temperature, max_new_tokens)
+        text = self._lookup(key)
+
+        if text is not None:
+            yield text
+            return
+
+        chunks = self.llm._stream(prompt, stopping_strings, temperature, max_new_tokens)
+        text = ""
+
+        try:
+            for chunk in chunks:
+                text += chunk
+                yield chunk
+        finally:
+            chunks.close()
+
+        # Only reached if the generation was not cancelled early
+        self.cache.set(key, CacheEntry(text))
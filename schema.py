@@ -0,0 +1,241 @@
+import os
+import threading
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:
+    # Only needed for columnar files and the conversion of CSV files
+    pa = None
+
+COLUMNAR_FILETYPES = ["parquet", "feather", "arrow"]
+
+
+def arrow_available() -> bool:
+    return pa is not None
+
+
+class ColumnInfo:
+    """Name, data type and a few example values of a column"""
+
+    def __init__(self, name: str, dtype: str, samples: list[str] = None):
+        self.name = name
+        self.dtype = dtype
+        self.samples = samples or []
+
+    def to_prompt(self) -> str:
+        prompt = f"{self.name}: {self.dtype}"
+
+        if self.samples:
+            prompt += f" (e.g. {', '.join(self.samples)})"
+
+        return prompt
+
+
+class FileSchema:
+    """Schema of a data file
+
+    `rows` is estimated from the size of the sample if `rows_exact` is False.
+    """
+
+    def __init__(
+        self,
+        columns: list[ColumnInfo],
+        rows: int | None = None,
+        rows_exact: bool = True,
+    ):
+        self.columns = columns
+        self.rows = rows
+        self.rows_exact = rows_exact
+
+    def to_prompt(self, name: str) -> str:
+        prompt = f"{name}"
+
+        if self.rows is not None:
+            prompt += f" ({'' if self.rows_exact else '~'}{self.rows} rows)"
+
+        return prompt + ": " + " | ".join(col.to_prompt() for col in self.columns)
+
+
+class SchemaCache:
+    """Infers the schema of data files from a bounded sample and caches it
+
+    CSV files are sampled, columnar files (Parquet, Feather, Arrow IPC) are described
+    from their metadata only.
+
+    Entries are keyed on path, size and modification time, so a changed file is
+    inferred again on the next lookup.
+    """
+
+    def __init__(
+        self,
+        sample_rows: int = 1000,
+        value_samples: int = 3,
+        max_sample_chars: int = 30,
+        count_rows_limit: int = 256 * 1024 * 1024,
+    ):
+        """
+        ARGUMENTS
+            sample_rows (int): Number of rows which are read to infer the data types
+            value_samples (int): Number of distinct example values per column
+            max_sample_chars (int): Example values are shortened to this length
+            count_rows_limit (int): Rows of larger files are estimated instead of counted
+        """
+
+        self.sample_rows = sample_rows
+        self.value_samples = value_samples
+        self.max_sample_chars = max_sample_chars
+        self.count_rows_limit = count_rows_limit
+
+        self._schemas: dict[str, tuple[tuple[int, int], FileSchema]] = {}
+        self._lock = threading.Lock()
+
+        self._infer = {
+            "csv": self._infer_csv,
+            "parquet": self._infer_parquet,
+            "feather": self._infer_arrow,
+            "arrow": self._infer_arrow,
+        }
+
+    def get(self, path: str, file_type: str) -> FileSchema:
+        """Return the schema of a file, infer it if the file is new or changed"""
+
+        path = os.path.abspath(path)
+
+        with self._lock:
+            cached = self._schemas.get(path)
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            # Uploaded files may be removed locally, their last schema stays valid
+            if cached is not None:
+                return cached[1]
+
+            raise
+
+        key = (stat.st_size, stat.st_mtime_ns)
+
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        if file_type not in self._infer:
+            raise ValueError(f"Unsupported file type {file_type}")
+
+        if file_type in COLUMNAR_FILETYPES and not arrow_available():
+            raise ValueError(f"pyarrow is required to read {file_type} files")
+
+        schema = self._infer[file_type](path, stat.st_size)
+
+        with self._lock:
+            self._schemas[path] = (key, schema)
+
+        return schema
+
+    def invalidate(self, path: str):
+        with self._lock:
+            self._schemas.pop(os.path.abspath(path), None)
+
+    def _columns(self, df: pd.DataFrame) -> list[ColumnInfo]:
+        return [
+            ColumnInfo(col, str(df[col].dtype), self._samples(df[col]))
+            for col in df.columns
+        ]
+
+    def _samples(self, series: pd.Series) -> list[str]:
+        samples = []
+
+        for value in series.dropna().unique()[: self.value_samples]:
+            text = str(value)
+
+            if len(text) > self.max_sample_chars:
+                text = text[: self.max_sample_chars] + "..."
+
+            samples.append(text)
+
+        return samples
+
+    def _infer_csv(self, path: str, size: int) -> FileSchema:
+        df = pd.read_csv(path, nrows=self.sample_rows)
+
+        if len(df) < self.sample_rows:
+            return FileSchema(self._columns(df), len(df))
+
+        if size <= self.count_rows_limit:
+            return FileSchema(self._columns(df), self._count_lines(path) - 1)
+
+        # Estimate the number of rows from the bytes used by the sample
+        with open(path, "rb") as f:
+            sample_bytes = sum(len(f.readline()) for _ in range(self.sample_rows + 1))
+
+        rows = int(size / sample_bytes * (self.sample_rows + 1)) - 1
+
+        return FileSchema(self._columns(df), rows, rows_exact=False)
+
+    def _arrow_columns(self, schema: "pa.Schema") -> list[ColumnInfo]:
+        return [ColumnInfo(field.name, str(field.type)) for field in schema]
+
+    def _infer_parquet(self, path: str, size: int) -> FileSchema:
+        # Only the footer is read
+        metadata = pq.read_metadata(path)
+
+        return FileSchema(
+            self._arrow_columns(metadata.schema.to_arrow_schema()), metadata.num_rows
+        )
+
+    def _infer_arrow(self, path: str, size: int) -> FileSchema:
+        try:
+            with pa.memory_map(path) as source:
+                reader = pa.ipc.open_file(source)
+
+                # Batches are memory-mapped, only their headers are touched
+                rows = sum(
+                    reader.get_batch(i).num_rows
+                    for i in range(reader.num_record_batches)
+                )
+
+                return FileSchema(self._arrow_columns(reader.schema), rows)
+        except pa.ArrowInvalid:
+            # Feather V1 files aren't Arrow IPC files
+            table = feather.read_table(path, memory_map=True)
+
+            return FileSchema(self._arrow_columns(table.schema), table.num_rows)
+
+    def _count_lines(self, path: str) -> int:
+        lines = 0
+        last = b"\n"
+
+        with open(path, "rb") as f:
+            while chunk := f.read(1 << 20):
+                lines += chunk.count(b"\n")
+                last = chunk[-1:]
+
+        # Last line without a trailing newline
+        return lines + (last != b"\n")
+
+
+def csv_to_arrow(src: str, dst: str, block_size: int = 16 * 1024 * 1024) -> str:
+    """Convert a CSV file to an uncompressed Arrow IPC file which can be memory-mapped
+
+    The CSV file is read in blocks, so it doesn't need to fit into memory. The conversion
+    is skipped if `dst` exists, so its path should depend on the content of `src`.
+    """
+
+    if os.path.exists(dst):
+        return dst
+
+    tmp = f"{dst}.tmp"
+    reader = pa_csv.open_csv(src, read_options=pa_csv.ReadOptions(block_size=block_size))
+
+    with pa.OSFile(tmp, "wb") as sink:
+        with pa.ipc.new_file(sink, reader.schema) as writer:
+            for batch in reader:
+                writer.write_batch(batch)
+
+    os.replace(tmp, dst)
+
+    return dst
@@ -1,9 +1,20 @@
+import os
+import asyncio
+import threading
 import gradio as gr
 
 
 import extensions.auto_llama.shared as shared
 
-from extensions.auto_llama.tool import WikipediaTool, DuckDuckGoSearchTool
+from extensions.auto_llama.tool import (
+    WikipediaTool,
+    DuckDuckGoSearchTool,
+    CachedTool,
+    OfflineWikipediaTool,
+    DocumentSearchTool,
+    ToolRegistry,
+)
+from extensions.auto_llama.search_index import DocumentIndex
 from extensions.auto_llama.agent import (
     ToolChainAgent,
     SummaryAgent,
@@ -12,7 +23,14 @@ from extensions.auto_llama.agent import (
     CodeAgent,
     is_active as agent_is_active,
 )
-from extensions.auto_llama.llm import OobaboogaLLM
+from extensions.auto_llama.llm import OobaboogaLLM, CachedLLM, LLMInterface
+from extensions.auto_llama.cache import TieredCache, MemoryCache, SQLiteCache
+from extensions.auto_llama.context import (
+    ContextBudget,
+    RegexTokenizer,
+    OobaboogaTokenizer,
+)
+from extensions.auto_llama.schema import SchemaCache
 from extensions.auto_llama.config import load_templates, get_active_template
 from extensions.auto_llama.ui import (
     tool_chain_agent_tab,
@@ -23,32 +41,91 @@ from extensions.auto_llama.ui import (
 )
 
 from modules import chat, extensions
+from modules import shared as webui_shared
 
 extension_name = "auto_llama"
 
 params = {
     "display_name": "AutoLLaMa",
     "api_endpoint": "http://localhost:5000",
+    "api_stream_endpoint": "ws://localhost:5005",
+    "api_pool_size": 4,
+    "api_connect_timeout": 5.0,
+    "api_read_timeout": 300.0,
+    "api_max_retries": 3,
+    "completion_cache": {
+        "enabled": False,
+        "agents": ["ObjectiveAgent"],
+        "max_entries": 1024,
+        "max_chars": 16_000_000,
+        "disk_path": None,
+        "disk_max_entries": 100_000,
+    },
     "verbose": True,
     "max_iter": 10,
+    "multi_action": False,
+    "prefetch_tools": False,
+    "max_context_tokens": 2048,
+    "tokenizer": "regex",
+    "offline_wikipedia_index": None,
+    "documents_path": None,
+    "documents_index": os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "cache", "documents.sqlite"
+    ),
+    "tool_cache": {
+        "enabled": True,
+        "ttl": {"Wikipedia": 86400, "DuckDuckGo": 3600},
+        "stale_ttl": 3600,
+        "negative_ttl": 60,
+        "max_entries": 512,
+        "max_chars": 8_000_000,
+        "disk_path": None,
+        "disk_max_entries": 10_000,
+    },
     "active_templates": {
         "ToolChainAgent": "default",
         "SummaryAgent": "default",
         "ObjectiveAgent": "default",
         "CodeAgent": "default",
     },
-    "active_tools": ["DuckDuckGo", "Wikipedia"],
+    "active_tools": ["DuckDuckGo", "Wikipedia", "Documents"],
     "active_agents": ["ToolChainAgent", "SummaryAgent", "ObjectiveAgent"],
     "allowed_packages": ["numpy", "pandas", "matplotlib"],
+    "data_schema": {"sample_rows": 1000, "value_samples": 3},
+    "convert_csv": False,
 }
 
 
+def get_llm(agent: str) -> LLMInterface:
+    """Return the LLM Interface which should be used by the given agent"""
+
+    if shared.cached_llm and agent in params["completion_cache"]["agents"]:
+        return shared.cached_llm
+
+    return shared.llm
+
+
+def get_active_tools():
+    return [tool for tool in shared.tools if tool.name in shared.active_tools]
+
+
+def get_tool_registry() -> ToolRegistry:
+    """Return the registry of the active tools, rebuild it if they changed"""
+
+    tools = get_active_tools()
+
+    if shared.tool_registry is None or shared.tool_registry.tools != tools:
+        shared.tool_registry = ToolRegistry(tools)
+
+    return shared.tool_registry
+
+
 def create_objective_agent():
     return ObjectiveAgent(
         "ObjectiveAgent",
         get_active_template("ObjectiveAgent"),
-        shared.llm,
-        [tool for tool in shared.tools if tool.name in shared.active_tools],
+        get_llm("ObjectiveAgent"),
+        get_active_tools(),
         verbose=params["verbose"],
     )
 
@@ -57,14 +134,22 @@ def create_tool_chain_agent():
     return ToolChainAgent(
         "ToolChainAgent",
         get_active_template("ToolChainAgent"),
-        shared.llm,
+        get_llm("ToolChainAgent"),
         SummaryAgent(
             "SummaryAgent",
             get_active_template("SummaryAgent"),
-            shared.llm,
+            get_llm("SummaryAgent"),
             verbose=params["verbose"],
         ),
-        [tool for tool in shared.tools if tool.name in shared.active_tools],
+        get_active_tools(),
+        context_budget=ContextBudget(
+            shared.tokenizer,
+            max_context_tokens=params["max_context_tokens"],
+            reserve_tokens=shared.llm.max_new_tokens,
+        ),
+        multi_action=params["multi_action"],
+        prefetch_tools=params["prefetch_tools"],
+        registry=get_tool_registry(),
         verbose=params["verbose"],
     )
 
@@ -74,9 +159,13 @@ def create_code_agent():
         shared.code_agent = CodeAgent(
             "CodeAgent",
             get_active_template("CodeAgent"),
-            shared.llm,
+            get_llm("CodeAgent"),
             shared.allowed_packages,
             executor_port=6060,
+            # The stop button of the webui also cancels the running code
+            stop_check=lambda: webui_shared.stop_everything,
+            schema_cache=SchemaCache(**params["data_schema"]),
+            convert_csv=params["convert_csv"],
             verbose=params["verbose"],
         )
     else:
@@ -85,7 +174,13 @@ def create_code_agent():
     return shared.code_agent
 
 
-def generate_objective(user_input: str, history: list[tuple[str, str]]):
+def get_conversation(state: dict) -> str:
+    """Key of the chat in the webui state, the code session is kept per chat"""
+
+    return state.get("unique_id") or CodeAgent.DEFAULT_CONVERSATION
+
+
+async def generate_objective(user_input: str, history: list[tuple[str, str]]):
     chat_messages = ""
     for message, reply in history:
         chat_messages += f"User: {message}\n" if message else ""
@@ -93,7 +188,39 @@ def generate_objective(user_input: str, history: list[tuple[str, str]]):
 
     chat_messages += f"User: {user_input}"
 
-    return create_objective_agent().run(chat_messages)
+    return await create_objective_agent().arun(chat_messages)
+
+
+async def run_tool_chain(objective: str) -> tuple[AnswerType, str]:
+    agent = create_tool_chain_agent()
+    kwargs = {
+        "max_iter": params["max_iter"],
+        "do_summary": agent_is_active("SummaryAgent"),
+    }
+
+    # Prefetching tools needs the streamed response of the sync path
+    if agent.prefetch_tools:
+        return await asyncio.to_thread(agent.run, objective, **kwargs)
+
+    return await agent.arun(objective, **kwargs)
+
+
+_event_loop_lock = threading.Lock()
+
+
+def run_async(coro):
+    """Run a coroutine on the event loop of the extension and wait for its result
+
+    The webui hooks are synchronous and need the result, but all agent runs share one
+    loop, so their LLM and tool requests overlap and the aiohttp sessions are reused.
+    """
+
+    with _event_loop_lock:
+        if shared.event_loop is None:
+            shared.event_loop = asyncio.new_event_loop()
+            threading.Thread(target=shared.event_loop.run_forever, daemon=True).start()
+
+    return asyncio.run_coroutine_threadsafe(coro, shared.event_loop).result()
 
 
 def setup():
@@ -104,7 +231,75 @@ def setup():
     shared.active_agents = set(params["active_agents"])
     shared.allowed_packages = set(params["allowed_packages"])
 
-    shared.llm = OobaboogaLLM(params["api_endpoint"])
+    shared.llm = OobaboogaLLM(
+        params["api_endpoint"],
+        stream_endpoint=params["api_stream_endpoint"],
+        pool_size=params["api_pool_size"],
+        connect_timeout=params["api_connect_timeout"],
+        read_timeout=params["api_read_timeout"],
+        max_retries=params["api_max_retries"],
+    )
+
+    # Built from scratch, so calling setup again doesn't add tools twice
+    shared.tools = [
+        # The local index replaces the online Wikipedia tool
+        OfflineWikipediaTool(params["offline_wikipedia_index"], max_articles=2)
+        if params["offline_wikipedia_index"]
+        else WikipediaTool(max_articles=2),
+        DuckDuckGoSearchTool(max_results=10),
+    ]
+
+    if params["documents_path"]:
+        shared.tools.append(
+            DocumentSearchTool(
+                DocumentIndex(params["documents_path"], params["documents_index"])
+            )
+        )
+
+    cache_params = params["tool_cache"]
+    if cache_params["enabled"]:
+        tool_cache = TieredCache(
+            MemoryCache(cache_params["max_entries"], cache_params["max_chars"]),
+            SQLiteCache(cache_params["disk_path"], cache_params["disk_max_entries"])
+            if cache_params["disk_path"]
+            else None,
+        )
+
+        # Local documents are kept up to date by the tool itself
+        shared.tools = [
+            CachedTool(
+                tool,
+                tool_cache,
+                ttl=cache_params["ttl"].get(tool.name, 3600),
+                stale_ttl=cache_params["stale_ttl"],
+                negative_ttl=cache_params["negative_ttl"],
+            )
+            if not isinstance(tool, DocumentSearchTool)
+            else tool
+            for tool in shared.tools
+        ]
+
+    # The webui tokenizer is exact but costs a request for every new prompt part
+    if params["tokenizer"] == "webui":
+        shared.tokenizer = OobaboogaTokenizer(
+            params["api_endpoint"], shared.llm.session, shared.llm.timeout
+        )
+    else:
+        shared.tokenizer = RegexTokenizer()
+
+    cache_params = params["completion_cache"]
+    if cache_params["enabled"]:
+        shared.cached_llm = CachedLLM(
+            shared.llm,
+            TieredCache(
+                MemoryCache(cache_params["max_entries"], cache_params["max_chars"]),
+                SQLiteCache(
+                    cache_params["disk_path"], cache_params["disk_max_entries"]
+                )
+                if cache_params["disk_path"]
+                else None,
+            ),
+        )
 
     create_code_agent()
 
@@ -155,18 +350,14 @@ def custom_generate_chat_prompt(user_input, state, **kwargs):
         user_input = user_input.replace("/do", "").lstrip()
 
         if agent_is_active("ObjectiveAgent"):
-            answer_type, objective = generate_objective(
-                user_input, state["history"]["visible"]
+            answer_type, objective = run_async(
+                generate_objective(user_input, state["history"]["visible"])
             )
         else:
             objective = user_input
 
         if agent_is_active("ToolChainAgent"):
-            answer_type, res = create_tool_chain_agent().run(
-                objective,
-                max_iter=params["max_iter"],
-                do_summary=agent_is_active("SummaryAgent"),
-            )
+            answer_type, res = run_async(run_tool_chain(objective))
         else:
             res = objective
 
@@ -204,7 +395,22 @@ Give a brief description of what the code does and summarize its ouput.
 
         user_input = user_input.replace("/code", "").lstrip()
 
-        answers = create_code_agent().run(user_input)
+        code_agent = create_code_agent()
+        conversation = get_conversation(state)
+
+        # A new or cleared chat starts with an empty namespace
+        if not state["history"]["internal"]:
+            code_agent.reset_session(conversation)
+
+        # Left over from a previous generation which was stopped
+        webui_shared.stop_everything = False
+
+        # Regenerating a reply runs from the same turn and may reuse its result
+        answers = run_async(
+            code_agent.arun(
+                user_input, conversation, epoch=len(state["history"]["internal"])
+            )
+        )
 
         if len(answers) <= 1:
             user_input = chat_context_string.format(code="", output=answers[0][1])
@@ -0,0 +1,686 @@
+import os
+import re
+import json
+import math
+import mmap
+import heapq
+import shutil
+import struct
+import sqlite3
+import hashlib
+import argparse
+import tempfile
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from itertools import accumulate, groupby
+from operator import attrgetter, itemgetter
+from typing import Iterable, Iterator
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list[str]:
+    """Split text into lowercase word tokens"""
+
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+def bm25(
+    tf: int,
+    df: int,
+    doc_len: int,
+    n_docs: int,
+    avg_len: float,
+    k1: float = 1.5,
+    b: float = 0.75,
+) -> float:
+    """BM25 score of a term in a document"""
+
+    idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+    return idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * doc_len / avg_len))
+
+
+def _map_file(path: str) -> mmap.mmap | bytes:
+    """Memory map a file read-only (empty files can't be mapped)"""
+
+    if os.path.getsize(path) == 0:
+        return b""
+
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _write_array(path: str, typecode: str, values: Iterable[int]):
+    with open(path, "wb") as f:
+        array(typecode, values).tofile(f)
+
+
+def _write_run(path: str, items: Iterable[tuple[str, array]]):
+    """Write (key, uint32 array) pairs sorted by key to a run file"""
+
+    with open(path, "wb") as f:
+        for key, values in items:
+            data = key.encode("utf-8")
+            f.write(struct.pack("<II", len(data), len(values)))
+            f.write(data)
+            values.tofile(f)
+
+
+def _read_run(path: str) -> Iterator[tuple[bytes, array]]:
+    with open(path, "rb") as f:
+        while header := f.read(8):
+            key_len, count = struct.unpack("<II", header)
+            key = f.read(key_len)
+
+            values = array("I")
+            values.fromfile(f, count)
+
+            yield (key, values)
+
+
+def _merge_runs(paths: list[str]) -> Iterator[tuple[bytes, list[array]]]:
+    """Merge run files and group the values of each key in the order of the runs"""
+
+    merged = heapq.merge(*(_read_run(path) for path in paths), key=itemgetter(0))
+
+    for key, group in groupby(merged, key=itemgetter(0)):
+        yield (key, [values for _, values in group])
+
+
+class SortedTable:
+    """Read-only string -> int tuple table stored on disk
+
+    Keys are stored sorted, so a lookup is a binary search over the memory mapped files.
+    """
+
+    def __init__(self, path: str, width: int):
+        self.width = width
+
+        self._keys = _map_file(f"{path}.keys")
+        self._offsets = memoryview(_map_file(f"{path}.idx")).cast("Q")
+        self._values = memoryview(_map_file(f"{path}.val")).cast("Q")
+
+    @staticmethod
+    def write(path: str, items: dict[str, tuple[int, ...]]):
+        """Write a table. All values need to have the same number of ints"""
+
+        SortedTable.write_sorted(
+            path, sorted((key.encode("utf-8"), value) for key, value in items.items())
+        )
+
+    @staticmethod
+    def write_sorted(path: str, items: Iterable[tuple[bytes, tuple[int, ...]]]):
+        """Write a table from (key, value) pairs which are already sorted by key"""
+
+        offset = 0
+
+        with open(f"{path}.keys", "wb") as keys, open(
+            f"{path}.idx", "wb"
+        ) as offsets, open(f"{path}.val", "wb") as values:
+            offsets.write(struct.pack("<Q", 0))
+
+            for key, value in items:
+                keys.write(key)
+                offset += len(key)
+                offsets.write(struct.pack("<Q", offset))
+                values.write(struct.pack(f"<{len(value)}Q", *value))
+
+    def __len__(self) -> int:
+        return max(len(self._offsets) - 1, 0)
+
+    def _key(self, i: int) -> bytes:
+        return self._keys[self._offsets[i] : self._offsets[i + 1]]
+
+    def get(self, key: str) -> tuple[int, ...] | None:
+        target = key.encode("utf-8")
+
+        low, high = 0, len(self)
+        while low < high:
+            mid = (low + high) // 2
+
+            if self._key(mid) < target:
+                low = mid + 1
+            else:
+                high = mid
+
+        if low == len(self) or self._key(low) != target:
+            return None
+
+        return tuple(self._values[low * self.width : (low + 1) * self.width])
+
+
+class _TermPostings:
+    """Postings of one query term with a cursor and an upper bound of its score"""
+
+    def __init__(self, docs: memoryview, tfs: memoryview, idf: float, max_score: float):
+        self.docs = docs
+        self.tfs = tfs
+        self.idf = idf
+        self.max_score = max_score
+        self.pos = 0
+
+
+class BM25Index:
+    """Static BM25 index over a document corpus stored in a directory
+
+    Documents are stored in one memory mapped file, terms and titles in `SortedTable`s.
+    The index is built once with `BM25Index.build` and only read afterwards.
+
+    Searches skip terms which occur in more than `max_df` of all documents (unless the
+    query has no other terms) and use MaxScore pruning, so postings of frequent terms
+    are only looked up for documents which can still make it into the top k.
+    """
+
+    VERSION = 1
+
+    def __init__(
+        self, path: str, k1: float = 1.5, b: float = 0.75, max_df: float = 0.5
+    ):
+        self.path = os.path.abspath(path)
+        self.k1 = k1
+        self.b = b
+        self.max_df = max_df
+
+        with open(os.path.join(self.path, "meta.json")) as f:
+            meta = json.load(f)
+
+        self.n_docs: int = meta["n_docs"]
+        self.avg_len: float = meta["avg_len"] or 1.0
+
+        self._docs = _map_file(os.path.join(self.path, "docs.bin"))
+        self._doc_offsets = memoryview(
+            _map_file(os.path.join(self.path, "docs.idx"))
+        ).cast("Q")
+        self._doc_lengths = memoryview(
+            _map_file(os.path.join(self.path, "lengths.bin"))
+        ).cast("I")
+        self._posting_docs = memoryview(
+            _map_file(os.path.join(self.path, "postings.docs"))
+        ).cast("I")
+        self._posting_tfs = memoryview(
+            _map_file(os.path.join(self.path, "postings.tfs"))
+        ).cast("I")
+
+        # term -> (offset, document frequency, max tf, min document length)
+        self.terms = SortedTable(os.path.join(self.path, "terms"), width=4)
+        self.titles = SortedTable(os.path.join(self.path, "titles"), width=1)
+
+    @staticmethod
+    def build(
+        documents: Iterable[tuple[str, str]], path: str, run_postings: int = 10_000_000
+    ) -> int:
+        """Build an index from (title, text) pairs
+
+        Postings are collected in memory until there are `run_postings` of them. They are
+        then written to a sorted run file and all runs are merged at the end, so the
+        postings of the whole corpus never have to fit into memory.
+
+        RETURNS
+            n_docs (int): Number of indexed documents
+        """
+
+        os.makedirs(path, exist_ok=True)
+        run_dir = tempfile.mkdtemp(prefix=".runs-", dir=path)
+
+        postings: dict[str, array] = defaultdict(lambda: array("I"))
+        titles: dict[str, array] = {}
+        n_postings = 0
+        runs: list[tuple[str, str]] = []
+
+        def flush():
+            n = len(runs)
+            run = (
+                os.path.join(run_dir, f"{n}.postings"),
+                os.path.join(run_dir, f"{n}.titles"),
+            )
+
+            _write_run(run[0], ((term, postings[term]) for term in sorted(postings)))
+            _write_run(run[1], ((title, titles[title]) for title in sorted(titles)))
+
+            runs.append(run)
+            postings.clear()
+            titles.clear()
+
+        doc_offsets = array("Q", [0])
+        doc_lengths = array("I")
+
+        try:
+            with open(os.path.join(path, "docs.bin"), "wb") as docs:
+                for doc_id, (title, text) in enumerate(documents):
+                    data = f"{title}\n{text}".encode("utf-8")
+                    docs.write(data)
+                    doc_offsets.append(doc_offsets[-1] + len(data))
+
+                    tokens = tokenize(f"{title}\n{text}")
+                    doc_lengths.append(len(tokens))
+
+                    counts = Counter(tokens)
+                    for term, tf in counts.items():
+                        postings[term].extend((doc_id, tf))
+
+                    n_postings += len(counts)
+                    titles.setdefault(title.strip().lower(), array("I", [doc_id]))
+
+                    if n_postings >= run_postings:
+                        flush()
+                        n_postings = 0
+
+            flush()
+
+            BM25Index._write_postings(path, [run[0] for run in runs], doc_lengths)
+
+            # Runs are in document order, so the first title is the one of the lowest id
+            SortedTable.write_sorted(
+                os.path.join(path, "titles"),
+                (
+                    (title, (values[0][0],))
+                    for title, values in _merge_runs([run[1] for run in runs])
+                ),
+            )
+        finally:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+        _write_array(os.path.join(path, "docs.idx"), "Q", doc_offsets)
+        _write_array(os.path.join(path, "lengths.bin"), "I", doc_lengths)
+
+        n_docs = len(doc_lengths)
+
+        with open(os.path.join(path, "meta.json"), mode="w") as f:
+            json.dump(
+                {
+                    "version": BM25Index.VERSION,
+                    "n_docs": n_docs,
+                    "avg_len": sum(doc_lengths) / n_docs if n_docs else 0,
+                },
+                f,
+            )
+
+        return n_docs
+
+    @staticmethod
+    def _write_postings(path: str, runs: list[str], doc_lengths: array):
+        """Merge the posting runs into the postings files and the term table"""
+
+        def terms() -> Iterator[tuple[bytes, tuple[int, int, int, int]]]:
+            offset = 0
+
+            with open(os.path.join(path, "postings.docs"), "wb") as docs, open(
+                os.path.join(path, "postings.tfs"), "wb"
+            ) as tfs:
+                for term, parts in _merge_runs(runs):
+                    count = 0
+                    max_tf = 0
+                    min_len = None
+
+                    for values in parts:
+                        term_docs, term_tfs = values[::2], values[1::2]
+                        term_docs.tofile(docs)
+                        term_tfs.tofile(tfs)
+
+                        count += len(term_docs)
+                        max_tf = max(max_tf, max(term_tfs))
+                        part_len = min(doc_lengths[doc_id] for doc_id in term_docs)
+                        min_len = part_len if min_len is None else min(min_len, part_len)
+
+                    yield (term, (offset, count, max_tf, min_len))
+                    offset += count
+
+        SortedTable.write_sorted(os.path.join(path, "terms"), terms())
+
+    def document(self, doc_id: int) -> tuple[str, str]:
+        """Return title and text of a document"""
+
+        data = self._docs[self._doc_offsets[doc_id] : self._doc_offsets[doc_id + 1]]
+        title, _, text = bytes(data).decode("utf-8").partition("\n")
+
+        return (title, text)
+
+    def find_title(self, title: str) -> int | None:
+        """Return the id of the document with the given (case insensitive) title"""
+
+        value = self.titles.get(title.strip().lower())
+        return value[0] if value else None
+
+    def _query_terms(self, query: str) -> list[_TermPostings]:
+        terms = []
+        frequent = []
+
+        for term in set(tokenize(query)):
+            entry = self.terms.get(term)
+            if entry is None:
+                continue
+
+            offset, count, max_tf, min_len = entry
+            idf = math.log(1 + (self.n_docs - count + 0.5) / (count + 0.5))
+
+            postings = _TermPostings(
+                self._posting_docs[offset : offset + count],
+                self._posting_tfs[offset : offset + count],
+                idf,
+                # The tf part of BM25 grows with tf and shrinks with the document length.
+                # The margin covers rounding differences to the summed scores.
+                bm25(max_tf, count, min_len, self.n_docs, self.avg_len, self.k1, self.b)
+                * (1 + 1e-9),
+            )
+
+            # Frequent terms barely change the ranking but have the longest postings
+            if count > self.max_df * self.n_docs:
+                frequent.append(postings)
+            else:
+                terms.append(postings)
+
+        return terms or frequent
+
+    def _score(self, term: _TermPostings, i: int, doc_id: int) -> float:
+        tf = term.tfs[i]
+        norm = 1 - self.b + self.b * self._doc_lengths[doc_id] / self.avg_len
+
+        return term.idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+
+    def search(self, query: str, k: int = 3) -> list[tuple[int, float]]:
+        """Return id and score of the `k` best matching documents"""
+
+        terms = sorted(self._query_terms(query), key=attrgetter("max_score"))
+
+        if not terms or k <= 0:
+            return []
+
+        # bounds[i]: Highest possible score of a document which only contains terms[:i + 1]
+        bounds = list(accumulate(term.max_score for term in terms))
+
+        top: list[tuple[float, int]] = []
+        threshold = 0.0
+        # Terms before `essential` can't get a document into the top k on their own, so
+        # their postings are only searched for candidates from the other terms
+        essential = 0
+
+        while essential < len(terms):
+            doc_id = min(
+                (
+                    term.docs[term.pos]
+                    for term in terms[essential:]
+                    if term.pos < len(term.docs)
+                ),
+                default=None,
+            )
+
+            if doc_id is None:
+                break
+
+            score = 0.0
+
+            for term in terms[essential:]:
+                if term.pos < len(term.docs) and term.docs[term.pos] == doc_id:
+                    score += self._score(term, term.pos, doc_id)
+                    term.pos += 1
+
+            for i in range(essential - 1, -1, -1):
+                if score + bounds[i] <= threshold:
+                    break
+
+                term = terms[i]
+                term.pos = bisect_left(term.docs, doc_id, term.pos)
+
+                if term.pos < len(term.docs) and term.docs[term.pos] == doc_id:
+                    score += self._score(term, term.pos, doc_id)
+
+            if len(top) < k:
+                heapq.heappush(top, (score, -doc_id))
+            elif score > top[0][0]:
+                heapq.heapreplace(top, (score, -doc_id))
+            else:
+                continue
+
+            if len(top) == k:
+                threshold = top[0][0]
+
+                while essential < len(terms) and bounds[essential] <= threshold:
+                    essential += 1
+
+        return [(-doc_id, score) for score, doc_id in sorted(top, reverse=True)]
+
+
+class DocumentIndex:
+    """Incremental BM25 index over the text files in a directory
+
+    Files are split into chunks of about `chunk_chars` characters at paragraph boundaries.
+    The index is stored in a SQLite database. On `update`, only files whose size or
+    modification time changed are hashed and only files whose content changed are re-indexed.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        db_path: str,
+        extensions: list[str] = [".txt", ".md", ".rst"],
+        chunk_chars: int = 1000,
+        k1: float = 1.5,
+        b: float = 0.75,
+    ):
+        self.directory = os.path.abspath(directory)
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.chunk_chars = chunk_chars
+        self.k1 = k1
+        self.b = b
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(db_path, check_same_thread=False)
+        self._con.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL NOT NULL, size INTEGER NOT NULL, hash TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, path TEXT NOT NULL, text TEXT NOT NULL, length INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, chunk_id INTEGER NOT NULL, tf INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS chunks_path ON chunks (path);
+            CREATE INDEX IF NOT EXISTS postings_term ON postings (term);
+            CREATE INDEX IF NOT EXISTS postings_chunk ON postings (chunk_id);
+            """
+        )
+
+        self._load_stats()
+
+    def _load_stats(self):
+        n_chunks, avg_len = self._con.execute(
+            "SELECT COUNT(*), AVG(length) FROM chunks"
+        ).fetchone()
+
+        self.n_chunks: int = n_chunks
+        self.avg_len: float = avg_len or 1.0
+
+    def _files(self) -> Iterator[str]:
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                if file.lower().endswith(self.extensions):
+                    yield os.path.join(root, file)
+
+    @staticmethod
+    def _hash(path: str) -> str:
+        sha = hashlib.sha256()
+
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+
+        return sha.hexdigest()
+
+    def _chunk(self, text: str) -> list[str]:
+        """Split text into chunks at paragraph boundaries"""
+
+        chunks = []
+        current = ""
+
+        for paragraph in re.split(r"\n\s*\n", text):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+
+            if current and len(current) + len(paragraph) > self.chunk_chars:
+                chunks.append(current)
+                current = ""
+
+            # Split paragraphs which are too long on their own
+            while len(paragraph) > self.chunk_chars:
+                chunks.append(paragraph[: self.chunk_chars])
+                paragraph = paragraph[self.chunk_chars :]
+
+            current = f"{current}\n\n{paragraph}" if current else paragraph
+
+        if current:
+            chunks.append(current)
+
+        return chunks
+
+    def _remove(self, path: str):
+        self._con.execute(
+            "DELETE FROM postings WHERE chunk_id IN (SELECT id FROM chunks WHERE path = ?)",
+            (path,),
+        )
+        self._con.execute("DELETE FROM chunks WHERE path = ?", (path,))
+        self._con.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def _add(self, path: str, mtime: float, size: int, file_hash: str):
+        with open(path, encoding="utf-8", errors="replace") as f:
+            text = f.read()
+
+        rel_path = os.path.relpath(path, self.directory)
+
+        for chunk in self._chunk(text):
+            tokens = tokenize(chunk)
+            chunk_id = self._con.execute(
+                "INSERT INTO chunks (path, text, length) VALUES (?, ?, ?)",
+                (rel_path, chunk, len(tokens)),
+            ).lastrowid
+            self._con.executemany(
+                "INSERT INTO postings (term, chunk_id, tf) VALUES (?, ?, ?)",
+                ((term, chunk_id, tf) for term, tf in Counter(tokens).items()),
+            )
+
+        self._con.execute(
+            "INSERT INTO files (path, mtime, size, hash) VALUES (?, ?, ?, ?)",
+            (rel_path, mtime, size, file_hash),
+        )
+
+    def update(self) -> int:
+        """Re-index changed files and remove deleted ones
+
+        RETURNS
+            n_changed (int): Number of added, changed or removed files
+        """
+
+        with self._lock:
+            known = {
+                path: (mtime, size, file_hash)
+                for path, mtime, size, file_hash in self._con.execute(
+                    "SELECT path, mtime, size, hash FROM files"
+                )
+            }
+            n_changed = 0
+
+            for path in self._files():
+                rel_path = os.path.relpath(path, self.directory)
+                stat = os.stat(path)
+                old = known.pop(rel_path, None)
+
+                if old and old[0] == stat.st_mtime and old[1] == stat.st_size:
+                    continue
+
+                file_hash = self._hash(path)
+
+                if old and old[2] == file_hash:
+                    # Only touched, content is unchanged
+                    self._con.execute(
+                        "UPDATE files SET mtime = ? WHERE path = ?",
+                        (stat.st_mtime, rel_path),
+                    )
+                    continue
+
+                self._remove(rel_path)
+                self._add(path, stat.st_mtime, stat.st_size, file_hash)
+                n_changed += 1
+
+            for rel_path in known:
+                self._remove(rel_path)
+                n_changed += 1
+
+            self._con.commit()
+            self._load_stats()
+
+        return n_changed
+
+    def search(self, query: str, k: int = 5) -> list[tuple[str, str, float]]:
+        """Return path, text and score of the `k` best matching chunks"""
+
+        scores: dict[int, float] = defaultdict(float)
+
+        with self._lock:
+            for term in set(tokenize(query)):
+                rows = self._con.execute(
+                    "SELECT p.chunk_id, p.tf, c.length FROM postings p JOIN chunks c ON c.id = p.chunk_id WHERE p.term = ?",
+                    (term,),
+                ).fetchall()
+
+                for chunk_id, tf, length in rows:
+                    scores[chunk_id] += bm25(
+                        tf,
+                        len(rows),
+                        length,
+                        self.n_chunks,
+                        self.avg_len,
+                        self.k1,
+                        self.b,
+                    )
+
+            best = heapq.nlargest(k, scores.items(), key=itemgetter(1))
+
+            results = []
+            for chunk_id, score in best:
+                path, text = self._con.execute(
+                    "SELECT path, text FROM chunks WHERE id = ?", (chunk_id,)
+                ).fetchone()
+                results.append((path, text, score))
+
+        return results
+
+    def close(self):
+        self._con.close()
+
+
+def read_jsonl(path: str) -> Iterator[tuple[str, str]]:
+    """Read (title, text) pairs from a JSON lines file (e.g. the output of WikiExtractor --json)"""
+
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+
+            doc = json.loads(line)
+            yield (doc["title"], doc["text"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build a BM25 index for the offline Wikipedia tool"
+    )
+    parser.add_argument(
+        "corpus", nargs="+", help="JSON lines files with `title` and `text` fields"
+    )
+    parser.add_argument("-o", "--output", required=True, help="Index directory")
+    parser.add_argument(
+        "--run-postings",
+        type=int,
+        default=10_000_000,
+        help="Postings which are kept in memory before they are written to a sorted run",
+    )
+    args = parser.parse_args()
+
+    n_docs = BM25Index.build(
+        (doc for path in args.corpus for doc in read_jsonl(path)),
+        args.output,
+        run_postings=args.run_postings,
+    )
+
+    print(f"Indexed {n_docs} documents into {args.output}")
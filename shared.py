@@ -1,18 +1,26 @@
+import asyncio
 import docker
 
-from extensions.auto_llama.tool import WikipediaTool, DuckDuckGoSearchTool, BaseTool
+from extensions.auto_llama.tool import BaseTool, ToolRegistry
 from extensions.auto_llama.agent import ToolChainAgent, SummaryAgent, AnswerType, ObjectiveAgent, CodeAgent
 from extensions.auto_llama.templates import ToolChainTemplate, SummaryTemplate, ObjectiveTemplate, CodeTemplate
 from extensions.auto_llama.llm import LLMInterface
+from extensions.auto_llama.context import Tokenizer
 
 templates: dict[str, dict[str, ToolChainTemplate | SummaryTemplate | ObjectiveTemplate | CodeTemplate]] = {}
 active_templates: dict[str, str] = {}
 
-tools: list[BaseTool] = [WikipediaTool(max_articles=2), DuckDuckGoSearchTool(max_results=10)]
+tools: list[BaseTool] = []
+""" Available tools (built by `setup`) """
 active_tools: set[str] = []
+tool_registry: ToolRegistry = None
+""" Compiled keywords of the active tools (rebuilt when `active_tools` changes) """
 allowed_packages: set[str] = []
 
 llm: LLMInterface = None
+cached_llm: LLMInterface = None
+""" Caching wrapper around `llm` (only set if the completion cache is enabled) """
+tokenizer: Tokenizer = None
 agents: dict[str, ToolChainAgent | SummaryAgent | ObjectiveAgent | CodeAgent] = None
 
 active_agents: set[str] = []
@@ -22,4 +30,7 @@ response_modifier: list[tuple[AnswerType, any]] = []
 
 code_agent: CodeAgent = None
 
+event_loop: asyncio.AbstractEventLoop = None
+""" Loop in a background thread on which the agents run """
+
 docker_client = docker.from_env()
\ No newline at end of file
@@ -1,4 +1,178 @@
-class ToolChainTemplate:
+import re
+
+
+class ParsedResponse:
+    """Structure of a ToolChainAgent LLM response"""
+
+    def __init__(
+        self,
+        text: str,
+        thought: str,
+        actions: list[tuple[str, str]],
+        final: str | None,
+    ):
+        self.text = text
+        """ Response truncated before the first observation """
+        self.thought = thought
+        self.actions = actions
+        """ (action, action input) pairs """
+        self.final = final
+
+
+class ToolChainParser:
+    """Compiled parser for the Thought/Action/Action Input/Observation/Final Answer structure
+
+    The response is tokenized in a single pass over all keywords at the start of a line.
+    """
+
+    def __init__(self, template: "ToolChainTemplate"):
+        self.final_keyword = template.final_keyword
+
+        self._kinds = {
+            template.thought_keyword.lower(): "thought",
+            template.tool_keyword.lower(): "action",
+            template.tool_query_keyword.lower(): "action_input",
+            template.observation_keyword.lower(): "observation",
+            template.final_keyword.lower(): "final",
+        }
+
+        # Longer keywords first, so `Action Input` isn't matched as `Action`
+        keywords = sorted(self._kinds, key=len, reverse=True)
+        self.keyword_pattern = re.compile(
+            rf"^[^\S\n]*({'|'.join(re.escape(keyword) for keyword in keywords)})[^\S\n]*\d*[^\S\n]*:",
+            re.MULTILINE | re.IGNORECASE,
+        )
+        self.action_input_pattern = re.compile(
+            rf"^{re.escape(template.tool_query_keyword)}\s*\d*\s*:[^\n]*\S[^\n]*\n",
+            re.MULTILINE,
+        )
+        self._leading_colon = re.compile(r"^\s*\d*\s*:")
+
+    def tokenize(
+        self, output: str, stop_at_observation: bool = True
+    ) -> tuple[list[tuple[str, str]], int]:
+        """Split the response into (kind, text) segments
+
+        Text in front of the first keyword is a thought (the prompt ends with the thought keyword).
+        Tokenizing stops at the first observation unless `stop_at_observation` is False.
+
+        RETURNS
+            segments (list[tuple[str, str]]): Kind and text of each segment
+            end (int): Index of the first observation (or the length of the response)
+        """
+
+        segments = []
+        kind = "thought"
+        start = 0
+        end = None
+
+        for match in self.keyword_pattern.finditer(output):
+            segments.append((kind, output[start : match.start()]))
+
+            kind = self._kinds[match.group(1).lower()]
+            start = match.end()
+
+            if kind == "observation":
+                end = match.start() if end is None else end
+
+                if stop_at_observation:
+                    return (segments, end)
+
+        segments.append((kind, output[start:]))
+
+        return (segments, len(output) if end is None else end)
+
+    def parse(self, output: str, multi_action: bool = False) -> ParsedResponse:
+        """Parse the response of a step
+
+        With `multi_action`, actions after observations which were generated by the model
+        are collected as well. The generated observations are ignored and so is a final
+        answer which follows them.
+        """
+
+        segments, end = self.tokenize(output, not multi_action)
+
+        text = output[:end]
+        thought = self._leading_colon.sub("", segments[0][1]).strip()
+        actions = []
+        final = None
+        action = None
+        observed = False
+
+        for kind, segment in segments:
+            segment = segment.strip()
+
+            if kind == "observation":
+                observed = True
+            elif kind == "final":
+                if observed:
+                    break
+
+                final = segment
+            elif kind == "thought" and not actions and action is None:
+                thought = self._leading_colon.sub("", segment).strip() or thought
+            elif kind == "action":
+                action = segment
+            elif kind == "action_input" and action is not None:
+                actions.append((action, segment))
+                action = None
+
+        # The final keyword might not be at the start of a line
+        if final is None and self.final_keyword in text:
+            final = self._leading_colon.sub("", text.split(self.final_keyword)[-1]).strip()
+
+        return ParsedResponse(text.strip(), thought, actions, final)
+
+
+class CodeParser:
+    """Compiled parser for code blocks in a CodeAgent LLM response"""
+
+    def __init__(self):
+        self.code_pattern = re.compile(r"```(?P<language>.*)\n(?P<code>[^`]*)\n```")
+
+    def extract(self, text: str) -> tuple[str, str]:
+        """Return language and code of the first code block"""
+
+        match = self.code_pattern.search(text)
+
+        if match is None:
+            raise ValueError("No code found in response")
+
+        return (match.group("language"), match.group("code").strip())
+
+
+class Template:
+    """Base class for prompt templates with a lazily compiled parser
+
+    The parser is invalidated whenever an attribute of the template is changed.
+    """
+
+    def _create_parser(self):
+        return None
+
+    @property
+    def parser(self):
+        if self.__dict__.get("_parser") is None:
+            self.__dict__["_parser"] = self._create_parser()
+
+        return self.__dict__["_parser"]
+
+    def build_parser(self):
+        """Compile the parser ahead of the first response"""
+
+        return self.parser
+
+    def __setattr__(self, name: str, value):
+        super().__setattr__(name, value)
+        self.__dict__["_parser"] = None
+
+    def to_dict(self) -> dict[str, str]:
+        """Template attributes which are saved to templates.json"""
+
+        return {key: val for key, val in self.__dict__.items() if not key.startswith("_")}
+
+
+class ToolChainTemplate(Template):
     """Prompt template information for the ToolChainAgent"""
 
     def __init__(
@@ -17,8 +191,11 @@ class ToolChainTemplate:
         self.final_keyword = final_keyword
         self.template = template
 
+    def _create_parser(self) -> ToolChainParser:
+        return ToolChainParser(self)
+
 
-class SummaryTemplate:
+class SummaryTemplate(Template):
     """Prompt template information for the SummaryAgent"""
 
     def __init__(
@@ -30,15 +207,18 @@ class SummaryTemplate:
         self.template = template
 
 
-class ObjectiveTemplate:
+class ObjectiveTemplate(Template):
     """Prompt template information for the ObjectiveAgent"""
 
     def __init__(self, template: str):
         self.template = template
 
 
-class CodeTemplate:
+class CodeTemplate(Template):
     """Prompt template information for the CodeAgent"""
 
     def __init__(self, template: str) -> None:
         self.template = template
+
+    def _create_parser(self) -> CodeParser:
+        return CodeParser()
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The extension is imported as `extensions.auto_llama` from the webui directory
+sys.path.insert(0, str(Path(__file__).resolve().parents[3]))
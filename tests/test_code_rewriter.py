@@ -0,0 +1,61 @@
+import sys
+from pathlib import Path
+
+# The executor modules import each other as top-level modules
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "code_exec"))
+
+from code_rewriter import CodeRewriter  # noqa: E402
+
+
+def execute(code: str, **kwargs) -> list[tuple]:
+    """Run rewritten code and return the arguments of every __display__ call"""
+
+    displayed = []
+    namespace = {
+        "__file__": "script.py",
+        "__display__": lambda *args: displayed.append(args),
+        "__show__": lambda obj, *config: obj,
+    }
+
+    exec(CodeRewriter("images", **kwargs).rewrite(code), namespace)
+
+    return displayed
+
+
+def test_display_name_and_call():
+    code = "a = [1, 2]\na\nlen(a)\n"
+
+    assert execute(code, preview_rows=5, preview_cols=3) == [
+        ([1, 2], 5, 3),
+        (2, 5, 3),
+    ]
+
+
+def test_display_tuple_is_one_argument():
+    code = "a, b = 1, 2\na, b\n"
+
+    assert execute(code) == [((1, 2), 20, 20)]
+
+
+def test_statements_without_value_are_not_displayed():
+    code = "a = 1\na += 1\nprint(a)\n'docstring'\nif a:\n    a\n"
+
+    assert execute(code) == []
+
+
+def test_line_numbers_are_kept():
+    rewriter = CodeRewriter("images")
+    code = "x = 1\n(x,\n x)\nraise ValueError\n"
+
+    rewritten = rewriter.rewrite(code)
+
+    assert rewritten.splitlines()[3] == "raise ValueError"
+
+
+def test_open_figures_are_only_saved_if_enabled():
+    code = "x = 1\n"
+
+    assert "__show__" not in CodeRewriter("images").rewrite(code)
+    assert "__show__(None" in CodeRewriter(
+        "images", save_open_figures=True
+    ).rewrite(code)
@@ -0,0 +1,38 @@
+from extensions.auto_llama.context import ContextBudget, RegexTokenizer
+from extensions.auto_llama.tool import ActionStep
+
+
+class FakePrompt:
+    """Minimal stand-in for a `ToolChainPrompt` with one block per observation"""
+
+    def __init__(self, *observations: str):
+        self.prefix = ""
+        self.tail = ""
+        self.steps = []
+        self.blocks = []
+        self.summarized = set()
+
+        for observation in observations:
+            step = ActionStep("", None, "")
+            step.set_observation(observation)
+            self.steps.append(step)
+            self.blocks.append(observation)
+
+    def set_observation(self, i: int, observation: str):
+        self.steps[i].set_observation(observation)
+        self.blocks[i] = observation
+
+
+def test_truncating_again_keeps_one_marker():
+    budget = ContextBudget(RegexTokenizer(), max_context_tokens=40, reserve_tokens=0)
+    prompt = FakePrompt(" ".join(f"word{i}" for i in range(100)))
+
+    budget.fit(prompt)
+    budget.max_context_tokens = 20
+    total = budget.fit(prompt)
+
+    observation = prompt.steps[0].observation
+
+    assert total <= 20
+    assert observation.endswith(ContextBudget.TRUNCATION_MARKER)
+    assert observation.count(ContextBudget.TRUNCATION_MARKER.strip()) == 1
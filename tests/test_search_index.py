@@ -0,0 +1,111 @@
+import os
+import filecmp
+from collections import Counter
+
+import pytest
+
+from extensions.auto_llama.search_index import BM25Index, bm25, read_jsonl, tokenize
+
+CORPUS = os.path.join(os.path.dirname(__file__), "fixtures", "wiki.jsonl")
+QUERIES = [
+    "python programming language",
+    "java island indonesia",
+    "garbage collector memory",
+    "bytecode interpreter",
+    "comedy",
+    "the python",
+]
+
+
+@pytest.fixture(scope="module")
+def docs() -> list[tuple[str, str]]:
+    return list(read_jsonl(CORPUS))
+
+
+@pytest.fixture(scope="module")
+def index_path(tmp_path_factory, docs) -> str:
+    path = str(tmp_path_factory.mktemp("index"))
+    BM25Index.build(docs, path)
+
+    return path
+
+
+def title(index: BM25Index, doc_id: int) -> str:
+    return index.document(doc_id)[0]
+
+
+def test_round_trip(index_path, docs):
+    index = BM25Index(index_path)
+
+    assert index.n_docs == len(docs)
+
+    for doc_id, doc in enumerate(docs):
+        assert index.document(doc_id) == doc
+
+    assert index.find_title("  java ") == 5
+    assert index.find_title("Python (programming language)") == 0
+    assert index.find_title("Kotlin") is None
+
+
+def test_ranking(index_path):
+    index = BM25Index(index_path)
+
+    assert title(index, index.search(QUERIES[0])[0][0]) == "Python (programming language)"
+    assert title(index, index.search(QUERIES[1])[0][0]) == "Java"
+    assert title(index, index.search(QUERIES[2])[0][0]).startswith("Garbage collection")
+    assert index.search("kotlin") == []
+
+
+def test_pruned_search_matches_exhaustive_scoring(index_path, docs):
+    index = BM25Index(index_path, max_df=1.0)
+
+    lengths = [len(tokenize(f"{title}\n{text}")) for title, text in docs]
+    counts = [Counter(tokenize(f"{title}\n{text}")) for title, text in docs]
+    avg_len = sum(lengths) / len(lengths)
+
+    for query in QUERIES:
+        terms = set(tokenize(query))
+        scores = [
+            sum(
+                bm25(count[term], sum(term in c for c in counts), length, len(docs), avg_len)
+                for term in terms
+                if term in count
+            )
+            for count, length in zip(counts, lengths)
+        ]
+        expected = sorted(
+            ((doc_id, score) for doc_id, score in enumerate(scores) if score > 0),
+            key=lambda item: (-item[1], item[0]),
+        )
+
+        for k in (1, 3, len(docs)):
+            result = index.search(query, k)
+
+            assert [doc_id for doc_id, _ in result] == [
+                doc_id for doc_id, _ in expected[:k]
+            ]
+            assert [score for _, score in result] == pytest.approx(
+                [score for _, score in expected[:k]]
+            )
+
+
+def test_frequent_terms_are_skipped(index_path):
+    index = BM25Index(index_path, max_df=0.6)
+
+    # "is" occurs in almost every document and doesn't change the ranking
+    assert index.search("python is") == index.search("python")
+    assert index.search("is")
+
+
+def test_merged_runs_match_single_run(index_path, docs, tmp_path):
+    BM25Index.build(docs, str(tmp_path), run_postings=5)
+
+    _, mismatch, errors = filecmp.cmpfiles(
+        index_path,
+        str(tmp_path),
+        [name for name in os.listdir(index_path) if not name.startswith(".")],
+        shallow=False,
+    )
+
+    assert not mismatch and not errors
+    assert not [name for name in os.listdir(tmp_path) if name.startswith(".runs")]
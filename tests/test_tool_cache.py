@@ -0,0 +1,114 @@
+import time
+import threading
+
+from extensions.auto_llama.cache import CacheEntry, MemoryCache, TieredCache
+from extensions.auto_llama.tool import BaseTool, CachedTool
+
+
+class FakeTool(BaseTool):
+    """Tool which returns the queued answers and counts its calls"""
+
+    NO_RESULT = "Nothing found"
+
+    def __init__(self, *answers: str):
+        self.answers = list(answers)
+        self.calls = 0
+        self.called = threading.Event()
+
+        super().__init__("Fake", "Fake tool")
+
+    def run(self, query: str, _: str) -> str:
+        self.calls += 1
+        self.called.set()
+
+        return self.answers.pop(0)
+
+
+def cached(tool: FakeTool, **kwargs) -> tuple[CachedTool, TieredCache]:
+    cache = TieredCache(MemoryCache())
+    return (CachedTool(tool, cache, **kwargs), cache)
+
+
+def age(cache: TieredCache, key: str, seconds: float):
+    """Move the creation time of a cache entry into the past"""
+
+    entry = cache.get(key)
+    cache.set(key, CacheEntry(entry.value, entry.created - seconds))
+
+
+def test_miss_then_hit():
+    tool = FakeTool("first", "second")
+    cached_tool, cache = cached(tool, ttl=60)
+
+    assert cached_tool.run("Query", "objective") == "first"
+    assert cached_tool.run("  query. ", "other objective") == "first"
+    assert tool.calls == 1
+    assert cache.stats.hits == 1
+
+
+def test_expired_result_is_fetched_again():
+    tool = FakeTool("first", "second")
+    cached_tool, cache = cached(tool, ttl=60)
+
+    cached_tool.run("query", "")
+    age(cache, cached_tool._key("query"), 61)
+
+    assert cached_tool.run("query", "") == "second"
+    assert tool.calls == 2
+
+
+def test_stale_result_is_served_and_revalidated():
+    tool = FakeTool("first", "second")
+    cached_tool, cache = cached(tool, ttl=60, stale_ttl=60)
+
+    cached_tool.run("query", "")
+    age(cache, cached_tool._key("query"), 90)
+    tool.called.clear()
+
+    assert cached_tool.run("query", "") == "first"
+    assert tool.called.wait(5)
+
+    # The background refresh stores the new result
+    deadline = time.time() + 5
+    while cache.get(cached_tool._key("query")).value != "second":
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+    assert cached_tool.run("query", "") == "second"
+    assert tool.calls == 2
+
+
+def test_empty_result_expires_early():
+    tool = FakeTool("Nothing found", "found")
+    cached_tool, cache = cached(tool, ttl=3600, stale_ttl=3600, negative_ttl=10)
+
+    assert cached_tool.run("query", "") == "Nothing found"
+    assert cached_tool.run("query", "") == "Nothing found"
+    assert tool.calls == 1
+
+    # Not served stale, but fetched again right away
+    age(cache, cached_tool._key("query"), 11)
+
+    assert cached_tool.run("query", "") == "found"
+    assert tool.calls == 2
+
+
+def test_empty_result_is_not_cached_without_negative_ttl():
+    tool = FakeTool("", "found")
+    cached_tool, _ = cached(tool, negative_ttl=0)
+
+    assert cached_tool.run("query", "") == ""
+    assert cached_tool.run("query", "") == "found"
+    assert tool.calls == 2
+
+
+def test_tools_with_the_same_name_dont_share_entries():
+    class OtherTool(FakeTool):
+        pass
+
+    cache = TieredCache(MemoryCache())
+    first = CachedTool(FakeTool("first"), cache)
+    other = CachedTool(OtherTool("other"), cache)
+
+    assert first.run("query", "") == "first"
+    assert other.run("query", "") == "other"
@@ -1,11 +1,24 @@
+import re
+import time
+import asyncio
+import threading
 from abc import ABC, abstractmethod
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    TimeoutError as FutureTimeoutError,
+)
 from itertools import islice
 
+import requests
 import wikipedia
 import wolframalpha
 from duckduckgo_search import DDGS
 
 from extensions.auto_llama.llm import LLMInterface
+from extensions.auto_llama.cache import CacheEntry, TieredCache
+from extensions.auto_llama.search_index import BM25Index, DocumentIndex
 
 class ActionStep:
     """One step in the action chain"""
@@ -47,6 +60,9 @@ class BaseTool(ABC):
     description: str
     keywords: list[str]
 
+    NO_RESULT: str = None
+    """ Answer of the tool if nothing was found """
+
     def __init__(self, name: str, description: str, keywords: list[str] | str = None):
         if not keywords:
             keywords = name
@@ -64,6 +80,20 @@ class BaseTool(ABC):
 
         raise NotImplementedError("Every tool needs to implement the `run` method")
 
+    async def arun(self, query: str, objective: str) -> str:
+        """Execute Tool without blocking the event loop
+
+        Runs the blocking `run` method in a worker thread by default.
+        Tools with a native async implementation should override this method.
+        """
+
+        return await asyncio.to_thread(self.run, query, objective)
+
+    def is_empty(self, result: str) -> bool:
+        """Check if a result of the tool means that nothing was found"""
+
+        return not result.strip() or result == self.NO_RESULT
+
     def is_tool(self, action_query: str) -> bool:
         """Check if this tool is meant by the action query"""
 
@@ -77,45 +107,446 @@ class BaseTool(ABC):
 class NoneTool(BaseTool):
     """Fallback tool, when no matching tool is found"""
 
+    NO_RESULT = "No tool was found to perform this Action"
+
     def __init__(self):
         super().__init__("None", "No matching tool was found")
 
     def run(self, query: str, _:str) -> str:
-        return "No tool was found to perform this Action"
+        return self.NO_RESULT
+
+    async def arun(self, query: str, objective: str) -> str:
+        return self.run(query, objective)
+
+
+class CachedTool(BaseTool):
+    """Tool which caches the results of another tool
+
+    Results are cached by tool class, tool name and normalized query for `ttl` seconds. Within the
+    following `stale_ttl` seconds, the stale result is returned and refreshed in the background.
+    Results without anything found are only cached for `negative_ttl` seconds and never
+    served stale. The objective is not part of the cache key.
+    """
+
+    def __init__(
+        self,
+        tool: BaseTool,
+        cache: TieredCache,
+        ttl: float = 3600,
+        stale_ttl: float = 0,
+        negative_ttl: float = 60,
+    ):
+        self.tool = tool
+        self.cache = cache
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+
+        self._refreshing: set[str] = set()
+        self._lock = threading.Lock()
+
+        super().__init__(tool.name, tool.description, tool.keywords)
+
+    @property
+    def stats(self):
+        return self.cache.stats
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        """Normalize whitespace, case and surrounding quotes/punctuation of a query"""
+
+        return " ".join(query.lower().split()).strip(" \"'.,;:!?")
+
+    def _key(self, query: str) -> str:
+        # Tools can share a name (e.g. the online and offline Wikipedia tool)
+        return f"{type(self.tool).__name__}:{self.tool.name}:{self.normalize(query)}"
+
+    def _fetch(self, key: str, query: str, objective: str) -> str:
+        result = self.tool.run(query, objective)
+
+        if self.negative_ttl > 0 or not self.is_empty(result):
+            self.cache.set(key, CacheEntry(result))
+
+        return result
+
+    def _refresh(self, key: str, query: str, objective: str):
+        try:
+            self._fetch(key, query, objective)
+        except Exception as err:
+            print(f"> Failed to refresh cached result of {self.name}: {err}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def run(self, query: str, objective: str) -> str:
+        key = self._key(query)
+        entry = self.cache.get(key)
+
+        if entry is None:
+            return self._fetch(key, query, objective)
+
+        if self.is_empty(entry.value):
+            if entry.age() > self.negative_ttl:
+                return self._fetch(key, query, objective)
+
+            return entry.value
+
+        if entry.age() > self.ttl + self.stale_ttl:
+            return self._fetch(key, query, objective)
+
+        if entry.age() > self.ttl:
+            # Serve the stale result and revalidate it in the background
+            with self._lock:
+                start = key not in self._refreshing
+                self._refreshing.add(key)
+
+            if start:
+                threading.Thread(
+                    target=self._refresh, args=(key, query, objective), daemon=True
+                ).start()
+
+        return entry.value
+
+    def is_empty(self, result: str) -> bool:
+        return self.tool.is_empty(result)
+
+    def is_tool(self, action_query: str) -> bool:
+        return self.tool.is_tool(action_query)
+
+
+class ToolRegistry:
+    """Resolves the tool meant by an action in a single pass over all keywords
+
+    All keywords are compiled into one case insensitive regex. An action which is exactly a
+    tool name or keyword wins. Otherwise tool names and primary keywords are preferred over
+    other keywords, then longer keywords over shorter ones, then earlier matches.
+    """
+
+    def __init__(self, tools: list[BaseTool]):
+        self.tools = tools
+
+        self._keywords: dict[str, tuple[BaseTool, int]] = {}
+
+        for tool in tools:
+            for i, keyword in enumerate([tool.name, *tool.keywords]):
+                # The first tool claiming a keyword keeps it
+                self._keywords.setdefault(keyword.lower(), (tool, 1 if i <= 1 else 0))
+
+        keywords = sorted(self._keywords, key=len, reverse=True)
+        self._pattern = (
+            re.compile(
+                "|".join(rf"(?<!\w){re.escape(keyword)}" for keyword in keywords),
+                re.IGNORECASE,
+            )
+            if keywords
+            else None
+        )
+
+    def resolve(self, action: str) -> BaseTool:
+        """Return the tool meant by the action or a `NoneTool`"""
+
+        exact = self._keywords.get(action.strip().lower())
+        if exact is not None:
+            return exact[0]
+
+        if self._pattern is None:
+            return NoneTool()
+
+        best = None
+        for match in self._pattern.finditer(action):
+            keyword = match.group(0).lower()
+            rank = (self._keywords[keyword][1], len(keyword), -match.start())
+
+            if best is None or rank > best[0]:
+                best = (rank, self._keywords[keyword][0])
+
+        return best[1] if best else NoneTool()
+
+
+class ToolRunner:
+    """Runs the tools of one step of the action chain on a thread pool
+
+    Tools can be started speculatively with `prefetch` while the LLM is still generating.
+    `run` reuses the result of a prefetched action if the final action matches it.
+    Speculative actions which don't match are cancelled (or their results discarded) on `close`.
+    """
+
+    def __init__(self, objective: str, max_workers: int = 4):
+        self.objective = objective
+        self.max_workers = max_workers
+        self._pool: ThreadPoolExecutor = None
+        self._futures: dict[tuple[str, str], Future] = {}
+
+    def _submit(self, step: ActionStep) -> Future:
+        key = (step.tool.name, step.action_query)
+
+        if key not in self._futures:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+
+            self._futures[key] = self._pool.submit(
+                step.tool.run, step.action_query, self.objective
+            )
+
+        return self._futures[key]
+
+    def prefetch(self, steps: list[ActionStep]):
+        """Start the tools of (partially generated) actions"""
+
+        for step in steps:
+            if step.is_final or isinstance(step.tool, NoneTool):
+                continue
+
+            self._submit(step)
+
+    def run(self, steps: list[ActionStep]) -> list[str]:
+        """Run the tools of the given actions in parallel and return their observations"""
+
+        # A single action which wasn't prefetched runs without a thread pool
+        if len(steps) == 1 and not self._futures:
+            return [steps[0].tool.run(steps[0].action_query, self.objective)]
+
+        futures = [self._submit(step) for step in steps]
+        return [future.result() for future in futures]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self) -> "ToolRunner":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
 
 
 class WikipediaTool(BaseTool):
     """Search wikipedia"""
 
-    def __init__(self, max_articles: int=1):
+    NO_RESULT = "No good Wikipedia Search Result was found"
+    DESCRIPTION = "Wikipedia serves as a versatile tool, offering uses such as gathering background information, exploring unfamiliar topics, finding reliable sources, understanding current events, discovering new interests, and obtaining a comprehensive overview on diverse subjects like historical events, scientific concepts, biographies of notable individuals, geographical details, cultural phenomena, artistic works, technological advancements, social issues, academic subjects, making it a valuable resource for learning and knowledge acquisition."
+    KEYWORDS = ["learn", "Learn", "discover", "Discover", "Wikipedia", "wikipedia"]
+
+    def __init__(
+        self,
+        max_articles: int = 1,
+        max_workers: int = 4,
+        timeout: float = 10.0,
+        max_chars: int = 4000,
+    ):
+        """
+        ARGUMENTS
+            max_articles (int): Maximum number of articles which are fetched per query
+            max_workers (int): Maximum number of articles which are fetched concurrently
+            timeout (float): Seconds to wait for each request to Wikipedia
+            max_chars (int): Stop fetching once this many characters were gathered (None: no limit)
+        """
+
         self.max_articles = max_articles
-        
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.max_chars = max_chars
+
+        # The wikipedia package sends its requests without a timeout, so the API is
+        # called directly (with its language and user agent settings)
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = wikipedia.USER_AGENT
+
         super().__init__(
             "Wikipedia",
-            description="Wikipedia serves as a versatile tool, offering uses such as gathering background information, exploring unfamiliar topics, finding reliable sources, understanding current events, discovering new interests, and obtaining a comprehensive overview on diverse subjects like historical events, scientific concepts, biographies of notable individuals, geographical details, cultural phenomena, artistic works, technological advancements, social issues, academic subjects, making it a valuable resource for learning and knowledge acquisition.",
-            keywords=["learn", "Learn", "discover", "Discover", "Wikipedia", "wikipedia"],
+            description=self.DESCRIPTION,
+            keywords=self.KEYWORDS,
+        )
+
+    def _request(self, **params) -> dict:
+        res = self.session.get(
+            wikipedia.API_URL,
+            params={"action": "query", "format": "json", **params},
+            timeout=self.timeout,
         )
+        res.raise_for_status()
+
+        return res.json()["query"]
+
+    def _search(self, query: str) -> list[str]:
+        try:
+            results = self._request(
+                list="search", srprop="", srlimit=self.max_articles, srsearch=query
+            )
+        except requests.RequestException as err:
+            print(f"> Wikipedia: search failed ({err})")
+            return []
+
+        return [result["title"] for result in results["search"]]
+
+    def _fetch_summary(self, article: str) -> str | None:
+        try:
+            pages = self._request(
+                prop="extracts",
+                explaintext="",
+                exintro="",
+                redirects="",
+                titles=article,
+            )["pages"]
+        except requests.RequestException:
+            return None
+
+        page = next(iter(pages.values()))
+
+        if "missing" in page:
+            return None
+
+        return page.get("extract") or None
 
     def run(self, query: str, _:str) -> str:
-        articles = wikipedia.search(query)[:self.max_articles]
-        
+        articles = self._search(query)[:self.max_articles]
+
+        if not articles:
+            return self.NO_RESULT
+
+        pool = ThreadPoolExecutor(max_workers=min(self.max_workers, len(articles)))
+        futures = {pool.submit(self._fetch_summary, article): article for article in articles}
+
+        fetched: dict[str, str] = {}
+        size = 0
+
+        try:
+            for future in as_completed(futures, timeout=self.timeout):
+                summary = future.result()
+                if summary is None:
+                    continue
+
+                fetched[futures[future]] = summary
+                size += len(summary)
+
+                if self.max_chars and size >= self.max_chars:
+                    break
+        except FutureTimeoutError:
+            timed_out = sum(not future.done() for future in futures)
+            print(f"> Wikipedia: {timed_out} article(s) timed out")
+        finally:
+            # Don't wait for slow or unneeded articles
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        # Keep the order of the search results
+        summaries = [f"{article}\n{fetched[article]}" for article in articles if article in fetched]
+
+        if not summaries:
+            return self.NO_RESULT
+
+        return "\n\n".join(summaries)
+
+
+class OfflineWikipediaTool(BaseTool):
+    """Search a local Wikipedia dump
+
+    Uses a BM25 index built with `python -m extensions.auto_llama.search_index <dump.jsonl> -o <index>`.
+    """
+
+    NO_RESULT = WikipediaTool.NO_RESULT
+
+    def __init__(self, index_path: str, max_articles: int = 1, max_chars: int = 2000):
+        self.index = BM25Index(index_path)
+        self.max_articles = max_articles
+        self.max_chars = max_chars
+
+        super().__init__(
+            "Wikipedia",
+            description=WikipediaTool.DESCRIPTION,
+            keywords=WikipediaTool.KEYWORDS,
+        )
+
+    def _summary(self, text: str) -> str:
+        """Cut the article after the last complete paragraph within `max_chars`"""
+
+        if len(text) <= self.max_chars:
+            return text
+
+        cut = text.rfind("\n", 0, self.max_chars)
+        return text[: cut if cut > 0 else self.max_chars].strip()
+
+    def run(self, query: str, _: str) -> str:
+        # An exact title match is the best result
+        doc_ids = []
+        title_match = self.index.find_title(query)
+        if title_match is not None:
+            doc_ids.append(title_match)
+
+        for doc_id, _ in self.index.search(query, self.max_articles + 1):
+            if doc_id not in doc_ids:
+                doc_ids.append(doc_id)
+
         summaries = []
-        for article in articles:
-            try:
-                summary = wikipedia.summary(article, auto_suggest=False)
-            except wikipedia.PageError as err:
-                continue
-            
-            summaries.append(f"{article}\n{summary}")
-            
+        for doc_id in doc_ids[: self.max_articles]:
+            title, text = self.index.document(doc_id)
+            summaries.append(f"{title}\n{self._summary(text)}")
+
         if not summaries:
-            return "No good Wikipedia Search Result was found"
-            
+            return self.NO_RESULT
+
         return "\n\n".join(summaries)
 
 
+class DocumentSearchTool(BaseTool):
+    """Search local documents"""
+
+    NO_RESULT = "No matching Document was found"
+
+    def __init__(
+        self,
+        index: DocumentIndex,
+        max_chunks: int = 5,
+        max_chars: int = 3000,
+        refresh_interval: float = 60,
+    ):
+        """
+        ARGUMENTS
+            index (DocumentIndex): Index over the document directory
+            max_chunks (int): Maximum number of chunks which are returned
+            max_chars (int): Maximum number of characters which are returned
+            refresh_interval (float): Seconds after which the directory is checked for changed files again
+        """
+
+        self.index = index
+        self.max_chunks = max_chunks
+        self.max_chars = max_chars
+        self.refresh_interval = refresh_interval
+
+        self._last_update = 0.0
+
+        super().__init__(
+            "Documents",
+            description="The Documents tool searches the internal documents and notes of the user. Use it for questions about internal projects, processes or any information which is not publicly available. Inputs are keywords or phrases related to the topic of interest",
+            keywords=["documents", "Documents", "docs", "Docs", "internal", "Internal"],
+        )
+
+    def run(self, query: str, _: str) -> str:
+        if time.time() - self._last_update > self.refresh_interval:
+            self.index.update()
+            self._last_update = time.time()
+
+        results = []
+        size = 0
+
+        for path, text, _ in self.index.search(query, self.max_chunks):
+            result = f"{path}\n{text}"
+
+            if results and size + len(result) > self.max_chars:
+                break
+
+            results.append(result[: self.max_chars - size])
+            size += len(results[-1])
+
+        if not results:
+            return self.NO_RESULT
+
+        return "\n\n".join(results)
+
+
 class DuckDuckGoSearchTool(BaseTool):
     """ Search DuckDuckGo """
+
+    NO_RESULT = "No good DuckDuckGo Search Result was found"
     
     def __init__(self, max_results: int=3):
         self.max_results = max_results
@@ -134,7 +565,7 @@ class DuckDuckGoSearchTool(BaseTool):
                 results += "\n\n" + t['title'] + "\n" + t['body'] + "\nSource: " + t['href']
 
             if results == "":
-                return "No good DuckDuckGo Search Result was found"
+                return self.NO_RESULT
 
             return results
         
\ No newline at end of file
@@ -273,6 +273,10 @@ def code_agent_tab():
         with gr.Group():
             file_exp = gr.File(file_count="multiple", label="Upload files")
 
+        with gr.Row():
+            cancel_btn = gr.Button(value="Cancel Running Code")
+            reset_session_btn = gr.Button(value="Reset Code Sessions")
+
     agent_active_checkbox.change(
         lambda enable: shared.active_agents.add(AGENT_NAME)
         if enable
@@ -329,6 +333,9 @@ def code_agent_tab():
         file_exp,
     ).then(lambda: None, None, file_exp)
 
+    cancel_btn.click(lambda: shared.code_agent.cancel(), None, None, queue=False)
+    reset_session_btn.click(lambda: shared.code_agent.reset_session(), None, None)
+
 
 def objective_agent_tab():
     """Tab for personalizing settings for the ObjectiveAgent"""
@@ -414,44 +421,26 @@ def objective_agent_tab():
     )
 
 
+def toggle_tool(name: str):
+    """Create event handler which enables/disables the given tool"""
+
+    return lambda active: shared.active_tools.add(name) if active else shared.active_tools.remove(name)
+
+
 def tool_tab():
     """Tab for disabling/enabling tools"""
 
     tool_choice: list[gr.Checkbox] = []
 
     with gr.Tab("Tools"):
-        tool = shared.tools[0]
-        tool_choice.append(
-            gr.Checkbox(
-                value=tool.name in shared.active_tools,
-                label=tool.name,
-                interactive=True,
+        for tool in shared.tools:
+            tool_choice.append(
+                gr.Checkbox(
+                    value=tool.name in shared.active_tools,
+                    label=tool.name,
+                    interactive=True,
+                )
             )
-        )
 
-        tool = shared.tools[1]
-        tool_choice.append(
-            gr.Checkbox(
-                value=tool.name in shared.active_tools,
-                label=tool.name,
-                interactive=True,
-            )
-        )
-
-    tool = shared.tools[0]
-    tool_choice[0].change(
-        lambda active: shared.active_tools.add(shared.tools[0].name)
-        if active
-        else shared.active_tools.remove(shared.tools[0].name),
-        tool_choice[0],
-        None,
-    )
-
-    tool = shared.tools[1]
-    tool_choice[1].change(
-        lambda active: shared.active_tools.add(shared.tools[1].name)
-        if active
-        else shared.active_tools.remove(shared.tools[1].name),
-        tool_choice[1],
-        None,
-    )
+    for tool, checkbox in zip(shared.tools, tool_choice):
+        checkbox.change(toggle_tool(tool.name), checkbox, None)